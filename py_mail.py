@@ -20,7 +20,7 @@
 #     REVISION: ---
 #=========================================================================
 
-import mailbox
+import mmap
 import email.errors
 import email.header
 import email.utils
@@ -39,6 +39,14 @@ import time
 import logging
 import argparse
 import gettext
+import itertools
+import collections
+import Queue
+import socket
+import threading
+import multiprocessing
+import multiprocessing.pool
+import calendar
 
 _ = gettext.gettext
 
@@ -65,6 +73,12 @@ class Argument(object):
             parser = argparse.ArgumentParser()
             parser.add_argument(
                 "-s", "--since", default="days=2", help=_("Time format: 1second, 2days, week=2"))
+            parser.add_argument(
+                "-r", "--rebuild-rollups", action="store_true",
+                help=_("Recompute the daily rollup tables from all messages and exit"))
+            parser.add_argument(
+                "-e", "--engine", default="sync", choices=["sync", "pipeline"],
+                help=_("IMAP fetch engine: 'sync' waits for every FETCH, 'pipeline' keeps several in flight"))
             Argument.args = parser.parse_args()
 
     @classmethod
@@ -94,6 +108,178 @@ class Argument(object):
         return since
 
 
+class LRUCache(object):
+
+    """Bounded, thread-safe LRU cache with hit/miss counters"""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses = self.misses + 1
+                return default
+
+            # most recently used goes last
+            self.data[key] = value
+            self.hits = self.hits + 1
+
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+
+            while (len(self.data) > self.size):
+                self.data.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.data)}
+
+
+def quote_mailbox(name):
+    """Quote a mailbox name as an IMAP string, e.g. 'Sent Items'"""
+    if (len(name) >= 2 and name[0] == '"' and name[-1] == '"'):
+        return name
+
+    return '"{}"'.format(name.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+class IMAPSession(object):
+
+    """Authenticated IMAP session kept alive across scheduler ticks"""
+
+    def __init__(self, params=None, mailbox="INBOX", account=None):
+        self.params = params
+        self.mailbox = mailbox
+        self.account = account or get_accounts(params)[0]
+        self.imap = None
+        self.uidvalidity = None
+
+        # key of sync state, e.g. 'lyshie@imap.mx.nthu.edu.tw/INBOX'
+        self.key = "{}@{}/{}".format(self.account['username'],
+                                     self.account['host'], mailbox)
+
+    def connect(self):
+        """Open, login and select the mailbox (read-only)"""
+        imap = imaplib.IMAP4(host=self.account['host'])
+
+        # close the socket if anything fails once it is open,
+        # or every retry of get() leaks one
+        connected = False
+        try:
+            imap.login(self.account['username'], self.account['password'])
+
+            typ, data = imap.select(quote_mailbox(self.mailbox), readonly=True)
+            if (typ != 'OK'):
+                raise imaplib.IMAP4.error(
+                    "SELECT {}: {}".format(self.mailbox, data[0]))
+            typ, data = imap.response("UIDVALIDITY")
+            uidvalidity = int(data[0])
+            connected = True
+        finally:
+            if (not connected):
+                try:
+                    imap.shutdown()
+                except (imaplib.IMAP4.error, socket.error):
+                    pass
+
+        self.imap = imap
+        self.uidvalidity = uidvalidity
+
+    def get(self):
+        """Get a live session, reconnect with exponential backoff if dropped"""
+        if (self.imap):
+            try:
+                self.imap.noop()
+                return self.imap
+            except (imaplib.IMAP4.error, socket.error), e:
+                debug(_("IMAP session lost ({})").format(e))
+                self.reset()
+
+        retries = int(self.params['imap_retries'])
+        delay = 1
+        for n in range(retries):
+            try:
+                self.connect()
+                return self.imap
+            except (imaplib.IMAP4.abort, socket.error), e:
+                if (n == retries - 1):
+                    raise
+
+                debug(_("IMAP connect failed ({}), retry in {}s").format(
+                    e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    def reset(self):
+        """Drop the session without talking to the server"""
+        if (self.imap):
+            try:
+                self.imap.shutdown()
+            except (imaplib.IMAP4.error, socket.error):
+                pass
+
+        self.imap = None
+
+    def close(self):
+        if (self.imap):
+            try:
+                self.imap.close()
+                self.imap.logout()
+            except (imaplib.IMAP4.error, socket.error):
+                pass
+
+        self.imap = None
+
+    def idle(self, timeout=180):
+        """
+            Wait for new mail with IDLE (RFC 2177)
+            Return True if the server reported EXISTS before 'timeout' seconds
+        """
+        imap = self.get()
+        if ("IDLE" not in imap.capabilities):
+            time.sleep(timeout)
+            return False
+
+        tag = imap._new_tag()
+        imap.send("{} IDLE\r\n".format(tag))
+        line = imap.readline()
+        if (not line.startswith("+")):
+            raise imaplib.IMAP4.error(line)
+
+        # an absolute deadline, untagged keepalives must not extend the wait
+        deadline = time.time() + timeout
+        exists = False
+        try:
+            while (not exists):
+                remaining = deadline - time.time()
+                if (remaining <= 0):
+                    break
+                imap.sock.settimeout(remaining)
+                line = imap.readline()
+                exists = line.startswith("*") and ("EXISTS" in line)
+        except socket.timeout:
+            pass
+        finally:
+            imap.sock.settimeout(None)
+
+        imap.send("DONE\r\n")
+        while (not line.startswith(tag)):
+            line = imap.readline()
+
+        return exists
+
+
 def debug(msg, *args, **kwargs):
     logger = logging.getLogger(__name__)
     logger.debug(msg, *args, **kwargs)
@@ -122,7 +308,28 @@ def get_config(filename=get_default_config()):
               'imap_username': 'lyshie',
               'imap_password': None,
               'imap_host': 'imap.mx.nthu.edu.tw',
+              'imap_batch_size': '500',
+              'imap_retries': '5',
+              'imap_idle': '0',
+              'imap_accounts': '',
+              'imap_folders': 'INBOX',
+              'imap_workers': '4',
+              'imap_pipeline_depth': '8',
+              'imap_page_size': '5000',
+              'imap_max_pages': '3',
               'sqlite3_database': 'maildir.db',
+              'sqlite3_journal_mode': 'WAL',
+              'sqlite3_synchronous': 'NORMAL',
+              'sqlite3_cache_size': '-65536',
+              'sqlite3_mmap_size': '268435456',
+              'sqlite3_busy_timeout': '5000',
+              'sqlite3_cached_statements': '200',
+              'db_engine': 'mysql',
+              'db_pool_size': '2',
+              'db_batch_size': '1000',
+              'db_queue_size': '4',
+              'maildir_workers': '0',
+              'rollup_timezone': 'Asia/Taipei',
               }
 
     for sec in config.sections():
@@ -132,48 +339,401 @@ def get_config(filename=get_default_config()):
     return params
 
 
-def create_table(db='sqlite3', params=None):
-    conn = None
+def get_accounts(params=None):
+    """
+        Get IMAP accounts, e.g.
+
+            [imap]
+            accounts = lyshie, alice
+            folders = INBOX
+
+            [imap_alice]
+            username = alice
+            folders = INBOX, Lists
+
+        Options missing in '[imap_<name>]' fall back to '[imap]'.
+        Without 'accounts' the '[imap]' section is the only account.
+    """
+    names = [n.strip() for n in params['imap_accounts'].split(",")]
+    names = [n for n in names if (n)] or [None]
+
+    accounts = []
+    for name in names:
+        def option(k):
+            if (name and params.get("imap_{}_{}".format(name, k))):
+                return params["imap_{}_{}".format(name, k)]
+            return params["imap_{}".format(k)]
+
+        account = {'host': option('host'),
+                   'username': option('username'),
+                   'password': option('password'),
+                   'folders': [f.strip() for f in option('folders').split(",")
+                               if (f.strip())]}
+
+        if (not account['password']):
+            account['password'] = getpass.getpass(
+                'IMAP Password ({username}@{host}): '.format(**account))
+            # do not ask again
+            if (name):
+                params["imap_{}_password".format(name)] = account['password']
+            else:
+                params['imap_password'] = account['password']
+
+        accounts.append(account)
+
+    return accounts
+
+
+# bump when adding a step to migrate_table()
+schema_version = 3
+
 
+def has_table(cur, name, db='sqlite3'):
     if (db == 'sqlite3'):
-        conn = sqlite3.connect(params['sqlite3_database'])
+        cur.execute('''
+            SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?
+            ''', (name, ))
     elif (db == 'mysql'):
-        conn = MySQLdb.connect(
-            params['mysql_host'], params['mysql_username'], params['mysql_password'] or getpass.getpass('MySQL Password: '), params['mysql_table'],  charset='utf8')
+        cur.execute("SHOW TABLES LIKE %s", [name])
+
+    return bool(cur.fetchone())
+
+
+def get_schema_version(cur, db='sqlite3'):
+    """Get the schema version, or None for a database without one"""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version
+        (
+            version INTEGER
+        )
+    ''')
+    cur.execute("SELECT MAX(version) FROM schema_version")
+
+    row = cur.fetchone()
+    if (row and row[0] is not None):
+        return int(row[0])
+
+
+def set_schema_version(cur, version, db='sqlite3'):
+    cur.execute("DELETE FROM schema_version")
+
+    if (db == 'sqlite3'):
+        cur.execute("INSERT INTO schema_version (version) VALUES (?)",
+                    (version, ))
+    elif (db == 'mysql'):
+        cur.execute("INSERT INTO schema_version (version) VALUES (%s)",
+                    [version])
+
+
+def migrate_table(cur, version, db='sqlite3', tz_name='Asia/Taipei'):
+    """Upgrade the tables in place from 'version' to 'schema_version'"""
+    if (version < 1):
+        # 0 => 1: auto-increment id, integer epoch date, indexes
+        debug(_("Migrate schema {} => {}").format(0, 1))
+
+        if (db == 'sqlite3'):
+            # SQLite cannot change column types, rebuild the table
+            cur.execute("ALTER TABLE message RENAME TO message_v0")
+            cur.execute('''
+                CREATE TABLE message
+                (
+                    id      INTEGER PRIMARY KEY AUTOINCREMENT,
+                    subject TEXT,
+                    date    INTEGER,
+                    s_from  TEXT,
+                    UNIQUE  (subject, date)
+                )
+            ''')
+            cur.execute('''
+                INSERT OR IGNORE INTO message (subject, date, s_from)
+                SELECT subject, CAST(date AS INTEGER), s_from FROM message_v0
+            ''')
+            cur.execute("DROP TABLE message_v0")
+        elif (db == 'mysql'):
+            cur.execute("SHOW COLUMNS FROM message LIKE 'id'")
+            if (not cur.fetchone()):
+                cur.execute('''
+                    ALTER TABLE message ADD COLUMN
+                    id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST
+                ''')
+
+            cur.execute("ALTER TABLE message MODIFY date BIGINT")
+
+            for name, columns in [("idx_date", "date"),
+                                  ("idx_from_date", "s_from, date")]:
+                cur.execute("SHOW INDEX FROM message WHERE Key_name = %s",
+                            [name])
+                if (not cur.fetchone()):
+                    cur.execute("ALTER TABLE message ADD INDEX {} ({})".format(
+                        name, columns))
+
+    if (version < 2):
+        # 1 => 2: full-text index on subject
+        debug(_("Migrate schema {} => {}").format(1, 2))
+
+        create_fulltext(cur, db=db)
+
+    if (version < 3):
+        # 2 => 3: daily rollups
+        debug(_("Migrate schema {} => {}").format(2, 3))
+
+        create_rollups(cur, db=db)
+        rebuild_rollups(cur, db=db, tz_name=tz_name)
+
+
+def create_fulltext(cur, db='sqlite3'):
+    """
+        Create the ngram FULLTEXT index of subjects on MySQL (5.7.6+),
+        which splits CJK text into bigrams.
+        InnoDB attaches its default (English) stopword list to an index
+        when it is created, and ngram drops every token containing a
+        stopword, e.g. 'mail' => 'ma', 'ai', 'il' would all be dropped
+        for 'a' and 'i'. So stopwords are disabled while creating it.
+        Return False without it (SQLite, MariaDB, MySQL < 5.7.6), web.py
+        then searches with LIKE.
+    """
+    if (db != 'mysql'):
+        return False
+
+    cur.execute("SHOW INDEX FROM message WHERE Key_name = 'ft_subject'")
+    if (cur.fetchone()):
+        return True
+
+    try:
+        cur.execute("SELECT @@SESSION.innodb_ft_enable_stopword")
+        stopword = int(cur.fetchone()[0])
+
+        cur.execute("SET SESSION innodb_ft_enable_stopword = OFF")
+        try:
+            cur.execute('''
+                ALTER TABLE message ADD FULLTEXT INDEX ft_subject (subject)
+                WITH PARSER ngram
+            ''')
+        finally:
+            cur.execute("SET SESSION innodb_ft_enable_stopword = {}".format(
+                stopword))
+    except MySQLdb.Error, e:
+        debug(_("WARN: full-text search disabled ({})").format(e))
+        return False
+
+    return True
+
+
+def create_rollups(cur, db='sqlite3'):
+    """
+        Create the daily message counts per sender and overall, 'day' is
+        the epoch of the local midnight, see local_day()
+    """
+    if (db == 'sqlite3'):
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS message_daily
+            (
+                day    INTEGER,
+                s_from TEXT,
+                count  INTEGER,
+                PRIMARY KEY (day, s_from)
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS message_daily_total
+            (
+                day   INTEGER PRIMARY KEY,
+                count INTEGER
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS message_daily_info
+            (
+                id       INTEGER PRIMARY KEY,
+                timezone TEXT
+            )
+        ''')
+    elif (db == 'mysql'):
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS message_daily
+            (
+                day    BIGINT,
+                s_from VARCHAR(255),
+                count  BIGINT,
+                PRIMARY KEY (day, s_from)
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS message_daily_total
+            (
+                day   BIGINT PRIMARY KEY,
+                count BIGINT
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS message_daily_info
+            (
+                id       INT PRIMARY KEY,
+                timezone VARCHAR(64)
+            )
+        ''')
+
+
+def get_rollup_timezone(cur):
+    """Timezone the rollups were computed in, None before any rebuild"""
+    cur.execute("SELECT timezone FROM message_daily_info WHERE id = 1")
+
+    row = cur.fetchone()
+    if (row):
+        return row[0]
+
+
+def check_rollups(cur, db='sqlite3', tz_name='Asia/Taipei'):
+    """Rebuild the rollups if they were computed in another timezone"""
+    stored = get_rollup_timezone(cur)
+    if (stored != tz_name):
+        debug(_("Rollup timezone {} => {}, rebuilding").format(stored, tz_name))
+        rebuild_rollups(cur, db=db, tz_name=tz_name)
+
+
+def create_table(db='sqlite3', params=None, conn=None):
+    keep = bool(conn)
+
+    if (not keep):
+        conn = open_table(db=db, params=params)
 
     cur = conn.cursor()
 
+    if (db == 'mysql'):
+        warnings.simplefilter('ignore', category=MySQLdb.Warning)
+
+    version = get_schema_version(cur, db=db)
+    if (version is None):
+        # tables created before versioning are schema 0
+        version = 0 if (has_table(cur, 'message', db=db)) else schema_version
+
+    tz_name = params['rollup_timezone'] if (params) else 'Asia/Taipei'
+    migrate_table(cur, version, db=db, tz_name=tz_name)
+
     if (db == 'sqlite3'):
         cur.execute('''
             CREATE TABLE IF NOT EXISTS message
             (
+                id      INTEGER PRIMARY KEY AUTOINCREMENT,
                 subject TEXT,
-                date    TEXT,
+                date    INTEGER,
                 s_from  TEXT,
                 UNIQUE  (subject, date)
             )
         ''')
+        cur.execute('''
+            CREATE INDEX IF NOT EXISTS idx_date ON message (date)
+        ''')
+        cur.execute('''
+            CREATE INDEX IF NOT EXISTS idx_from_date ON message (s_from, date)
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state
+            (
+                mailbox     TEXT PRIMARY KEY,
+                uidvalidity INTEGER,
+                last_uid    INTEGER
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS maildir_index
+            (
+                name  TEXT PRIMARY KEY,
+                mtime INTEGER,
+                size  INTEGER
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS mbox_state
+            (
+                path        TEXT PRIMARY KEY,
+                last_offset INTEGER
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS message_stats
+            (
+                id      INTEGER PRIMARY KEY,
+                count   INTEGER,
+                version INTEGER,
+                updated INTEGER
+            )
+        ''')
     elif (db == 'mysql'):
-        warnings.simplefilter('ignore', category=MySQLdb.Warning)
         cur.execute('''
             CREATE TABLE IF NOT EXISTS message
             (
+                id      INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
                 subject VARCHAR(255),
-                date    VARCHAR(255),
+                date    BIGINT,
                 s_from  VARCHAR(255),
-                UNIQUE  (subject, date)
+                UNIQUE  (subject, date),
+                INDEX   idx_date (date),
+                INDEX   idx_from_date (s_from, date)
+            )
+        ''')
+        create_fulltext(cur, db=db)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state
+            (
+                mailbox     VARCHAR(255) PRIMARY KEY,
+                uidvalidity BIGINT,
+                last_uid    BIGINT
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS maildir_index
+            (
+                name  VARCHAR(255) PRIMARY KEY,
+                mtime BIGINT,
+                size  BIGINT
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS mbox_state
+            (
+                path        VARCHAR(255) PRIMARY KEY,
+                last_offset BIGINT
             )
         ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS message_stats
+            (
+                id      INT PRIMARY KEY,
+                count   BIGINT,
+                version BIGINT,
+                updated BIGINT
+            )
+        ''')
+
+    create_rollups(cur, db=db)
+    check_rollups(cur, db=db, tz_name=tz_name)
+
+    # counted once, then kept up to date by insert_many_into_table()
+    cur.execute("SELECT id FROM message_stats WHERE id = 1")
+    if (not cur.fetchone()):
+        cur.execute('''
+            INSERT INTO message_stats (id, count, version, updated)
+            SELECT 1, COUNT(*), 1, {} FROM message
+        '''.format(int(time.time())))
+
+    set_schema_version(cur, schema_version, db=db)
+
+    if (db == 'mysql'):
         warnings.resetwarnings()
 
     conn.commit()
-    conn.close()
+    if (not keep):
+        conn.close()
 
 
 def open_table(db='sqlite3', params=None):
     conn = None
     if (db == 'sqlite3'):
-        conn = sqlite3.connect(params['sqlite3_database'])
+        conn = sqlite3.connect(
+            params['sqlite3_database'],
+            cached_statements=int(params['sqlite3_cached_statements']))
+        tune_sqlite(conn, params)
     elif (db == 'mysql'):
         conn = MySQLdb.connect(
             params['mysql_host'], params['mysql_username'], params['mysql_password'] or getpass.getpass('MySQL Password: '), params['mysql_table'], charset='utf8')
@@ -183,38 +743,494 @@ def open_table(db='sqlite3', params=None):
     return conn
 
 
+def tune_sqlite(conn, params=None):
+    """
+        Apply the write-performance pragmas of '[sqlite3]'.
+        With WAL journaling readers (e.g. web.py) do not block the writer.
+    """
+    re_name = re.compile(r"^\w+$")
+
+    pragmas = [("journal_mode", params['sqlite3_journal_mode']),
+               ("synchronous", params['sqlite3_synchronous']),
+               ("cache_size", int(params['sqlite3_cache_size'])),
+               ("mmap_size", int(params['sqlite3_mmap_size'])),
+               ("busy_timeout", int(params['sqlite3_busy_timeout']))]
+
+    cur = conn.cursor()
+    for name, value in pragmas:
+        # pragmas take no bound parameters
+        if (not re_name.match(str(value).lstrip("-"))):
+            raise ValueError("{} = {}".format(name, value))
+
+        cur.execute("PRAGMA {} = {}".format(name, value))
+
+
 def close_table(conn):
     if (conn):
         conn.commit()
         conn.close()
 
 
+class Storage(object):
+
+    """Database engine, keeps a pool of open connections across ticks"""
+
+    db = None
+
+    def __init__(self, params=None):
+        self.params = params
+        self.pool = Queue.Queue(maxsize=int(params['db_pool_size']) or 1)
+
+    def connect(self):
+        return open_table(db=self.db, params=self.params)
+
+    def alive(self, conn):
+        return True
+
+    def get(self):
+        """Get a connection from the pool, or open a new one"""
+        while (True):
+            try:
+                conn = self.pool.get_nowait()
+            except Queue.Empty:
+                return self.connect()
+
+            if (self.alive(conn)):
+                return conn
+
+    def put(self, conn):
+        """Commit and give the connection back to the pool"""
+        conn.commit()
+
+        try:
+            self.pool.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def create_table(self):
+        conn = self.get()
+        create_table(db=self.db, params=self.params, conn=conn)
+        self.put(conn)
+
+    def close(self):
+        while (True):
+            try:
+                self.pool.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+class SQLiteStorage(Storage):
+    db = 'sqlite3'
+
+
+class MySQLStorage(Storage):
+    db = 'mysql'
+
+    def __init__(self, params=None):
+        super(MySQLStorage, self).__init__(params)
+
+        # ask once, not on every reconnect
+        if (not params['mysql_password']):
+            params['mysql_password'] = getpass.getpass('MySQL Password: ')
+
+    def alive(self, conn):
+        # idle connections are dropped after 'wait_timeout'
+        try:
+            conn.ping()
+            return True
+        except MySQLdb.Error:
+            return False
+
+
+def get_storage(params=None):
+    """Get the storage engine of '[db] engine' with its tables created"""
+    engines = {'sqlite3': SQLiteStorage, 'mysql': MySQLStorage}
+
+    storage = engines[params['db_engine']](params)
+    storage.create_table()
+
+    return storage
+
+
 def insert_into_table(conn, items, db='sqlite3'):
+    return insert_many_into_table(conn, [items], db=db)
+
+
+def parse_mysql_info(info):
+    """Parse 'Records: 3  Duplicates: 1  Warnings: 0' into a dict"""
+    return dict([(k.lower(), int(v))
+                 for k, v in re.findall(r"(\w+):\s*(\d+)", info or "")])
+
+
+def get_upsert_counts(rowcount, info):
+    """
+        (new, updated) of a MySQL INSERT ... ON DUPLICATE KEY UPDATE.
+        Without CLIENT_FOUND_ROWS the affected rows are 1 per new row,
+        2 per updated row and 0 per unchanged row, and 'Duplicates' of
+        info() counts the updated rows only.
+    """
+    updated = parse_mysql_info(info).get('duplicates', 0)
+    new = rowcount - 2 * updated
+
+    return (new, updated)
+
+
+def insert_many_into_table(conn, rows, db='sqlite3', batch_size=1000,
+                           tz_name='Asia/Taipei'):
+    """
+        Upsert (subject, date, s_from) rows, one transaction per batch.
+        Rows already stored unchanged are skipped instead of replaced.
+        Daily rollups are updated in the same transaction.
+        Return {'new': n, 'updated': n, 'skipped': n}
+    """
+    stats = {'new': 0, 'updated': 0, 'skipped': 0}
+
+    if (conn):
+        cur = conn.cursor()
+
+        for batch in chunks(rows, batch_size or 1):
+            # stored rows of the batch before the upsert, matched by the
+            # database itself (collation, column width)
+            set_batch_keys(cur, batch, db=db)
+            before = get_batch_rows(cur)
+
+            if (db == 'sqlite3'):
+                cur.executemany('''
+                    INSERT OR IGNORE INTO message (subject, date, s_from) VALUES (?, ?, ?)
+                    ''', batch)
+                new = cur.rowcount
+
+                cur.executemany('''
+                    UPDATE message SET s_from = ? WHERE subject = ? AND date = ? AND s_from IS NOT ?
+                    ''', [(r[2], r[0], r[1], r[2]) for r in batch])
+                updated = cur.rowcount
+            elif (db == 'mysql'):
+                # one multi-row statement, so that info() covers the whole batch
+                values = ", ".join(["(%s, %s, %s)"] * len(batch))
+                cur.execute('''
+                    INSERT INTO message (subject, date, s_from) VALUES {}
+                    ON DUPLICATE KEY UPDATE s_from = VALUES(s_from)
+                    '''.format(values), list(itertools.chain(*batch)))
+
+                new, updated = get_upsert_counts(cur.rowcount, conn.info())
+
+            if (new or updated):
+                # for readers like web.py, in the same transaction
+                update_stats(cur, new, db=db)
+
+                daily, total = get_rollup_deltas(before, get_batch_rows(cur),
+                                                 tz_name=tz_name)
+                update_rollups(cur, daily, total, db=db)
+
+            conn.commit()
+
+            stats['new'] = stats['new'] + new
+            stats['updated'] = stats['updated'] + updated
+            stats['skipped'] = stats['skipped'] + len(batch) - new - updated
+
+    debug(_("New = {new}, Updated = {updated}, Skipped = {skipped}").format(
+        **stats))
+
+    return stats
+
+
+def update_stats(cur, new, db='sqlite3'):
+    """Add new rows to the message count and bump the data version"""
+    if (db == 'sqlite3'):
+        cur.execute('''
+            UPDATE message_stats SET count = count + ?, version = version + 1,
+            updated = ? WHERE id = 1
+            ''', (new, int(time.time())))
+    elif (db == 'mysql'):
+        cur.execute('''
+            UPDATE message_stats SET count = count + %s, version = version + 1,
+            updated = %s WHERE id = 1
+            ''', [new, int(time.time())])
+
+
+day_cache = {}
+
+
+def local_day(t, tz_name='Asia/Taipei'):
+    """Epoch of the local midnight starting the day of 't'"""
+    # UTC offsets are multiples of 15 minutes
+    key = (tz_name, t // 900)
+    day = day_cache.get(key)
+    if (day is None):
+        if (len(day_cache) > 100000):
+            day_cache.clear()
+
+        dt = py_today.Today(t, tz_name).begin_of_today()
+        day = calendar.timegm(dt.utctimetuple())
+        day_cache[key] = day
+
+    return day
+
+
+def to_unicode(value):
+    if (isinstance(value, str)):
+        return value.decode("utf-8", "replace")
+
+    return value
+
+
+def set_batch_keys(cur, batch, db='sqlite3'):
+    """Stage the (subject, date) keys of a batch in a temporary table"""
+    if (db == 'sqlite3'):
+        cur.execute('''
+            CREATE TEMPORARY TABLE IF NOT EXISTS batch_keys
+            (
+                subject TEXT,
+                date    INTEGER
+            )
+        ''')
+        cur.execute("DELETE FROM batch_keys")
+        cur.executemany("INSERT INTO batch_keys (subject, date) VALUES (?, ?)",
+                        [r[:2] for r in batch])
+    elif (db == 'mysql'):
+        # same column types as message, so that values compare alike
+        cur.execute('''
+            CREATE TEMPORARY TABLE IF NOT EXISTS batch_keys
+            (
+                subject VARCHAR(255),
+                date    BIGINT
+            )
+        ''')
+        cur.execute("DELETE FROM batch_keys")
+        cur.executemany("INSERT INTO batch_keys (subject, date) VALUES (%s, %s)",
+                        [r[:2] for r in batch])
+
+
+def get_batch_rows(cur):
+    """{id: (date, s_from)} of the stored messages the staged keys match"""
+    cur.execute('''
+        SELECT DISTINCT m.id, m.date, m.s_from
+        FROM batch_keys k JOIN message m
+        ON m.subject = k.subject AND m.date = k.date
+    ''')
+
+    return dict([(r[0], (r[1], to_unicode(r[2]))) for r in cur.fetchall()])
+
+
+def get_rollup_deltas(before, after, tz_name='Asia/Taipei'):
+    """
+        Changes of the daily counts between two get_batch_rows(), as
+        ({(day, s_from): n}, {day: n}): new messages count for their
+        sender, messages whose sender changed move from the old one to the
+        new one
+    """
+    daily = collections.Counter()
+    total = collections.Counter()
+
+    for id, (date, s_from) in after.iteritems():
+        old = before.get(id)
+        if (old and old[1] == s_from):
+            continue
+
+        day = local_day(date, tz_name)
+        if (old):
+            daily[(day, old[1] or u"")] -= 1
+        else:
+            total[day] += 1
+        daily[(day, s_from or u"")] += 1
+
+    return (daily, total)
+
+
+def update_rollups(cur, daily, total, db='sqlite3'):
+    """Add {(day, s_from): n} and {day: n} to the rollup tables"""
+    daily = [(d, f, n) for (d, f), n in daily.iteritems() if (n)]
+    total = [(d, n) for d, n in total.iteritems() if (n)]
+
+    if (db == 'sqlite3'):
+        cur.executemany('''
+            INSERT OR IGNORE INTO message_daily (day, s_from, count) VALUES (?, ?, 0)
+            ''', [(d, f) for d, f, n in daily])
+        cur.executemany('''
+            UPDATE message_daily SET count = count + ? WHERE day = ? AND s_from = ?
+            ''', [(n, d, f) for d, f, n in daily])
+        cur.executemany('''
+            INSERT OR IGNORE INTO message_daily_total (day, count) VALUES (?, 0)
+            ''', [(d, ) for d, n in total])
+        cur.executemany('''
+            UPDATE message_daily_total SET count = count + ? WHERE day = ?
+            ''', [(n, d) for d, n in total])
+    elif (db == 'mysql'):
+        if (daily):
+            cur.executemany('''
+                INSERT INTO message_daily (day, s_from, count) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE count = count + VALUES(count)
+                ''', daily)
+        if (total):
+            cur.executemany('''
+                INSERT INTO message_daily_total (day, count) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE count = count + VALUES(count)
+                ''', total)
+
+
+def rebuild_rollups(cur, db='sqlite3', tz_name='Asia/Taipei'):
+    """Recompute the rollup tables from the whole message table"""
+    cur.execute("DELETE FROM message_daily")
+    cur.execute("DELETE FROM message_daily_total")
+    cur.execute("DELETE FROM message_daily_info")
+
+    if (db == 'sqlite3'):
+        cur.execute("INSERT INTO message_daily_info (id, timezone) VALUES (1, ?)",
+                    (tz_name, ))
+    elif (db == 'mysql'):
+        cur.execute("INSERT INTO message_daily_info (id, timezone) VALUES (1, %s)",
+                    [tz_name])
+
+    # 15-minute slots in SQL, local days in Python
+    cur.execute('''
+        SELECT date - date % 900 AS slot, s_from, COUNT(*) FROM message
+        WHERE date IS NOT NULL GROUP BY slot, s_from
+    ''')
+
+    daily = collections.Counter()
+    total = collections.Counter()
+    for slot, s_from, count in cur.fetchall():
+        day = local_day(int(slot), tz_name)
+        daily[(day, to_unicode(s_from) or u"")] += int(count)
+        total[day] += int(count)
+
+    update_rollups(cur, daily, total, db=db)
+
+    return sum(total.values())
+
+
+def get_sync_state(conn, mailbox, db='sqlite3'):
+    """Get (uidvalidity, last_uid) stored for the mailbox, or (None, 0)"""
+    if (conn):
+        cur = conn.cursor()
+
+        if (db == 'sqlite3'):
+            cur.execute('''
+                SELECT uidvalidity, last_uid FROM sync_state WHERE mailbox = ?
+                ''', (mailbox, ))
+        elif (db == 'mysql'):
+            cur.execute('''
+                SELECT uidvalidity, last_uid FROM sync_state WHERE mailbox = %s
+                ''', [mailbox])
+
+        row = cur.fetchone()
+        if (row):
+            return (int(row[0]), int(row[1]))
+
+    return (None, 0)
+
+
+def set_sync_state(conn, mailbox, uidvalidity, last_uid, db='sqlite3'):
+    if (conn):
+        cur = conn.cursor()
+
+        if (db == 'sqlite3'):
+            cur.execute('''
+                REPLACE INTO sync_state (mailbox, uidvalidity, last_uid) VALUES (?, ?, ?)
+                ''', (mailbox, uidvalidity, last_uid))
+        elif (db == 'mysql'):
+            cur.execute('''
+                REPLACE INTO sync_state (mailbox, uidvalidity, last_uid) VALUES (%s, %s, %s)
+                ''', [mailbox, uidvalidity, last_uid])
+
+
+def get_maildir_index(conn, db='sqlite3'):
+    """Get {unique name: (mtime, size)} of ingested Maildir files"""
+    index = {}
+
+    if (conn):
+        cur = conn.cursor()
+        cur.execute("SELECT name, mtime, size FROM maildir_index")
+
+        for name, mtime, size in cur.fetchall():
+            index[name] = (int(mtime), int(size))
+
+    return index
+
+
+def set_maildir_index(conn, entries, db='sqlite3'):
+    """Record (unique name, mtime, size) of ingested Maildir files"""
+    if (conn and entries):
+        cur = conn.cursor()
+
+        if (db == 'sqlite3'):
+            cur.executemany('''
+                REPLACE INTO maildir_index (name, mtime, size) VALUES (?, ?, ?)
+                ''', entries)
+        elif (db == 'mysql'):
+            cur.executemany('''
+                REPLACE INTO maildir_index (name, mtime, size) VALUES (%s, %s, %s)
+                ''', entries)
+
+
+def get_mbox_offset(conn, path, db='sqlite3'):
+    """Get the offset of the last scanned message in the mbox, or 0"""
+    if (conn):
+        cur = conn.cursor()
+
+        if (db == 'sqlite3'):
+            cur.execute('''
+                SELECT last_offset FROM mbox_state WHERE path = ?
+                ''', (path, ))
+        elif (db == 'mysql'):
+            cur.execute('''
+                SELECT last_offset FROM mbox_state WHERE path = %s
+                ''', [path])
+
+        row = cur.fetchone()
+        if (row):
+            return int(row[0])
+
+    return 0
+
+
+def set_mbox_offset(conn, path, offset, db='sqlite3'):
     if (conn):
         cur = conn.cursor()
 
         if (db == 'sqlite3'):
             cur.execute('''
-                REPLACE INTO message (subject, date, s_from) VALUES (?, ?, ?)
-                ''' ,  (items[0], items[1], items[2]))
+                REPLACE INTO mbox_state (path, last_offset) VALUES (?, ?)
+                ''', (path, offset))
         elif (db == 'mysql'):
             cur.execute('''
-                REPLACE INTO message (subject, date, s_from) VALUES (%s, %s, %s)
-                ''' ,  [items[0], items[1], items[2]])
+                REPLACE INTO mbox_state (path, last_offset) VALUES (%s, %s)
+                ''', [path, offset])
+
+
+re_lf = re.compile(r'[\n\r]+')
+re_con = re.compile(r'\?==\?')
+
+# the same Subject/From come again and again from mailing lists
+header_cache = LRUCache(10000)
 
 
 def decode_header(raw, defaults=["utf-8", "big5"]):
     if (not raw):
         return u""
 
-    # pre-process
-    raw = raw.replace("?gb2312?", "?gbk?")
+    # plain ASCII without encoded words needs no MIME decoding
+    if ("=?" not in raw):
+        try:
+            return re_lf.sub("", raw).decode("ascii")
+        except UnicodeError:
+            pass
+
+    key = (raw, tuple(defaults))
+    result = header_cache.get(key)
+    if (result is None):
+        result = _decode_header(raw, defaults)
+        header_cache.put(key, result)
 
-    lf = re.compile(r'[\n\r]+')
-    raw = lf.sub("", raw)
+    return result
 
-    con = re.compile(r'\?==\?')
-    raw = con.sub('?= =?', raw)
+
+def _decode_header(raw, defaults=["utf-8", "big5"]):
+    # pre-process
+    raw = raw.replace("?gb2312?", "?gbk?")
+    raw = re_lf.sub("", raw)
+    raw = re_con.sub('?= =?', raw)
 
     result = u""
 
@@ -244,115 +1260,279 @@ def decode_header(raw, defaults=["utf-8", "big5"]):
     return u"".join(pairs)
 
 
-def load_mbox(params=None):
-    md = mailbox.mbox(os.path.expanduser(params['mbox_path']))
+def chunks(items, size):
+    """Split an iterable into consecutive lists of at most 'size' items"""
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if (not batch):
+            break
 
-    keys = md.keys()
-    keys.sort(cmp=lambda x, y: cmp(x, y))
+        yield batch
 
-    create_table(db='mysql', params=params)
-    conn = open_table(db='mysql', params=params)
 
-    for k in keys:
+def compress_uids(uids):
+    """Compress UIDs into an IMAP sequence set, e.g. '1001:1500,1502'"""
+    ranges = []
+    for u in sorted(int(x) for x in uids):
+        if (ranges and u == ranges[-1][1] + 1):
+            ranges[-1][1] = u
+        else:
+            ranges.append([u, u])
+
+    return ",".join([str(a) if (a == b) else "{}:{}".format(a, b)
+                     for a, b in ranges])
+
+
+def parse_fetch_headers(data):
+    """Parse a multi-message FETCH response into {uid: raw header}"""
+    re_uid = re.compile(r"UID (\d+)")
+
+    headers = {}
+    pending = None
+    for item in data or []:
+        if (isinstance(item, tuple)):
+            m = re_uid.search(item[0])
+            if (m):
+                headers[m.group(1)] = item[1] or ""
+                pending = None
+            else:
+                # some servers send UID after the literal, e.g. ' UID 1001)'
+                pending = item[1] or ""
+        elif (item and pending is not None):
+            m = re_uid.search(item)
+            if (m):
+                headers[m.group(1)] = pending
+            pending = None
+
+    return headers
+
+
+def is_mbox_offset(data, offset):
+    """Whether 'offset' of the mbox 'data' is at a 'From ' separator"""
+    if (offset == 0):
+        return True
+
+    return data[offset - 1:offset + 5] == "\nFrom "
+
+
+def scan_mbox(filename, offset=0):
+    """
+        Scan an mbox file from 'offset' with mmap, only the header block of
+        each message is read. Yield (offset of message, raw header)
+    """
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if (size <= offset):
+            return
+
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         try:
-            msg = md.get(k)
-        except email.errors.MessageParseError:
-            continue
+            if (not is_mbox_offset(mm, offset)):
+                # rewritten (expunged, compacted), start over
+                offset = 0
+
+            # align to the next 'From ' separator
+            if (mm[offset:offset + 5] != "From "):
+                offset = mm.find("\nFrom ", offset)
+                if (offset >= 0):
+                    offset = offset + 1
+
+            while (offset >= 0):
+                following = mm.find("\nFrom ", offset)
+                end = size if (following < 0) else following + 1
+
+                # skip the 'From ' line, stop at the first empty line
+                begin = mm.find("\n", offset, end) + 1 or end
+                blanks = [p for p in [mm.find("\n\n", begin - 1, end),
+                                      mm.find("\n\r\n", begin - 1, end)]
+                          if (p >= 0)]
+                stop = min(blanks) + 1 if (blanks) else end
+
+                yield (offset, mm[begin:max(begin, stop)])
+
+                offset = following + 1 if (following >= 0) else -1
+        finally:
+            mm.close()
+
+
+def load_mbox(params=None, storage=None):
+    filename = os.path.expanduser(params['mbox_path'])
+
+    own = not storage
+    storage = storage or get_storage(params)
+    conn = storage.get()
+
+    offset = get_mbox_offset(conn, filename, db=storage.db)
+    with open(filename, "rb") as f:
+        f.seek(max(offset - 1, 0))
+        head = f.read(6)
+
+    if (offset > os.path.getsize(filename) or
+            (offset and not is_mbox_offset(head, 1))):
+        # truncated or rewritten, e.g. expunged or compacted
+        debug(_("mbox rewritten, rescan {}").format(filename))
+        offset = 0
+
+    # the last message is scanned again next time, in case it was still
+    # being appended
+    last = [offset]
+
+    def items():
+        for start, raw in scan_mbox(filename, offset):
+            last[0] = start
+            yield (start, raw)
+
+    insert_many_into_table(conn, parse_dates(decode_headers(items())),
+                           db=storage.db, batch_size=int(params['db_batch_size']),
+                           tz_name=params['rollup_timezone'])
+
+    set_mbox_offset(conn, filename, last[0], db=storage.db)
+    storage.put(conn)
+    if (own):
+        storage.close()
+
+
+def read_header(filename):
+    """Read the header block of a message file, not the body"""
+    lines = []
+    with open(filename, "rb") as f:
+        for line in f:
+            if (line in ("\n", "\r\n")):
+                break
 
-        raw = msg.get("subject")
-        subject = decode_header(raw)
+            lines.append(line)
 
-        date = msg.get("date")
-        dt = email.utils.parsedate_tz(date)
-        t = 0
-        if (dt):
-            t = email.utils.mktime_tz(dt)
-        else:
-            t = 0
+    return "".join(lines)
 
-        s_from = msg.get("from")
-        s_from = decode_header(s_from)
-        r, e = rfc822.parseaddr(s_from)
-        if (e):
-            s_from = e
 
-        # subject is Unicode
-        debug(u"{} ({}) <{}>".format(subject, t, s_from))
-        insert_into_table(conn, [subject, str(t), s_from], db='mysql')
+def parse_maildir_file(entry):
+    """
+        Parse one Maildir file (runs in a worker process)
+        Return (name, mtime, size, row), row is None if the file is gone
+    """
+    name, filename, mtime, size = entry
 
-    close_table(conn)
+    try:
+        raw = read_header(filename)
+    except (IOError, OSError):
+        # moved from 'new' to 'cur' meanwhile, picked up next time
+        return (name, mtime, size, None)
 
+    rows = list(parse_dates(decode_headers([(name, raw)])))
 
-def load_maildir(params=None):
-    md = mailbox.Maildir(os.path.expanduser(params["maildir_dirname"]))
+    return (name, mtime, size, rows[0])
 
-    keys = md.keys()
-    keys.sort(cmp=lambda x, y: cmp(x, y))
 
-    create_table(db='mysql', params=params)
-    conn = open_table(db='mysql', params=params)
+def scan_maildir(dirname, index=None):
+    """
+        List (name, filename, mtime, size) of new or changed Maildir files
+        name is the unique part of the filename, without ':2,<flags>'
+    """
+    index = index or {}
+    entries = []
 
-    for k in keys:
-        try:
-            msg = md.get(k)
-        except email.errors.MessageParseError:
-            continue
+    for sub in ("new", "cur"):
+        path = os.path.join(dirname, sub)
+        for f in os.listdir(path):
+            if (f.startswith(".")):
+                continue
 
-        raw = msg.get("subject")
-        subject = decode_header(raw)
+            filename = os.path.join(path, f)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
 
-        date = msg.get("date")
-        dt = email.utils.parsedate_tz(date)
-        t = 0
-        if (dt):
-            t = email.utils.mktime_tz(dt)
-        else:
-            t = 0
+            name = f.split(":")[0]
+            mtime = int(st.st_mtime)
+            if (index.get(name) == (mtime, st.st_size)):
+                continue
 
-        s_from = msg.get("from")
-        s_from = decode_header(s_from)
-        r, e = rfc822.parseaddr(s_from)
-        if (e):
-            s_from = e
+            entries.append((name, filename, mtime, st.st_size))
 
-        # subject is Unicode
-        debug(u"{} ({}) <{}>".format(subject, t, s_from))
-        insert_into_table(conn, [subject, str(t), s_from], db='mysql')
+    return entries
 
-    close_table(conn)
 
+def load_maildir(params=None, storage=None):
+    dirname = os.path.expanduser(params["maildir_dirname"])
+    batch_size = int(params['db_batch_size'])
 
-def load_imap(params=None):
-    imap = imaplib.IMAP4(host=params['imap_host'])
-    imap.login(params['imap_username'], params[
-               'imap_password'] or getpass.getpass('IMAP Password: '))
+    own = not storage
+    storage = storage or get_storage(params)
+    conn = storage.get()
 
-    imap.select(readonly=True)
+    index = get_maildir_index(conn, db=storage.db)
+    entries = scan_maildir(dirname, index)
+    debug(_("Maildir: {} new or changed files").format(len(entries)))
 
-    #typ, nums = imap.uid("SEARCH", "ALL")
+    # parse headers on all cores, write from this process only
+    pool = multiprocessing.Pool(int(params['maildir_workers']) or None)
+    try:
+        results = pool.imap_unordered(parse_maildir_file, entries,
+                                      chunksize=64)
+
+        for batch in chunks(results, batch_size):
+            done = [r for r in batch if (r[3])]
+
+            insert_many_into_table(conn, [r[3] for r in done], db=storage.db,
+                                   batch_size=batch_size,
+                                   tz_name=params['rollup_timezone'])
+            set_maildir_index(conn, [r[:3] for r in done], db=storage.db)
+            conn.commit()
+    finally:
+        pool.close()
+        pool.join()
+
+    storage.put(conn)
+    if (own):
+        storage.close()
+
+
+def fetch_headers(imap, uids, batch_size=500, depth=1,
+                  query='(BODY[HEADER.FIELDS (Subject Date From)])'):
+    """
+        Fetch raw headers with one UID FETCH per batch. Yield (uid, header)
+        With depth > 1, up to 'depth' tagged commands are pipelined on the
+        connection, so the round-trip latency is not paid for every batch.
+    """
+    count = len(uids)
+
+    if (depth <= 1):
+        for batch in chunks(uids, batch_size):
+            debug(_("Current = {}").format(count))
+            count = count - len(batch)
 
-    today = py_today.Today()
-    #yesterday = today - "days=1"
-    since = today - Argument.get_since(Argument.args.since)
+            typ, data = imap.uid("FETCH", compress_uids(batch), query)
+            for item in parse_fetch_headers(data).iteritems():
+                yield item
 
-    typ, nums = imap.uid("SEARCH", "SINCE", since.format_time(
-        format="%d-%b-%Y"))
+        return
 
-    msgs = {}
+    # imaplib has no public API for pipelining, but _command() sends a
+    # tagged command without waiting and _command_complete() collects it
+    pending = collections.deque()
+    for batch in chunks(uids, batch_size):
+        pending.append(imap._command("UID", "FETCH", compress_uids(batch),
+                                     query))
+        count = count - len(batch)
 
-    count = 15000
-    for i in reversed(nums[0].split()):
-        if (count % 500 == 0):
+        if (len(pending) >= depth or count == 0):
             debug(_("Current = {}").format(count))
 
-        count = count - 1
-        if (count < 0):
-            break
+        while (pending and (len(pending) >= depth or count == 0)):
+            imap._command_complete("UID", pending.popleft())
+
+            # each untagged FETCH response is stored completely
+            data = imap.untagged_responses.pop("FETCH", [])
+            for item in parse_fetch_headers(data).iteritems():
+                yield item
 
-        typ, data = imap.uid(
-            "FETCH", i, '(BODY[HEADER.FIELDS (Subject Date From)])')
 
-        header = email.message_from_string(data[0][1] or "")
+def decode_headers(items):
+    """Decode (uid, raw header) into (subject, raw date, s_from)"""
+    for i, raw in items:
+        header = email.message_from_string(raw)
 
         subject = header['Subject'] or ""
         date = header['Date'] or ""
@@ -361,45 +1541,226 @@ def load_imap(params=None):
         if (e):
             s_from = e
 
-        msgs[i] = {'subject': decode_header(subject),
-                   'date': date,
-                   'from': decode_header(s_from)}
+        yield (decode_header(subject), date, decode_header(s_from))
 
-    imap.close()
-    imap.logout()
 
-    create_table(db='mysql', params=params)
-    conn = open_table(db='mysql', params=params)
-
-    count = 0
-    for m in reversed(sorted(msgs.keys())):
-        count = count + 1
+def parse_dates(msgs):
+    """Turn (subject, raw date, s_from) into (subject, epoch, s_from) rows"""
+    for subject, date, s_from in msgs:
         dt = None
-        if (msgs[m]['date']):
-            dt = email.utils.parsedate_tz(msgs[m]['date'])
+        if (date):
+            dt = email.utils.parsedate_tz(date)
 
         if (dt):
             t = email.utils.mktime_tz(dt)
         else:
             t = 0
 
-        insert_into_table(
-            conn, [msgs[m]['subject'], str(t), msgs[m]['from']], db='mysql')
+        yield (subject, t, s_from)
+
+
+def fetch_imap(params=None, session=None, last_validity=None, last_uid=0):
+    """
+        Search new mails on an IMAP session (no database access)
+        Return (uidvalidity, pages), where pages is a generator of
+        (last_uid, rows) in ascending UID order, and rows is a generator of
+        (subject, date, s_from) fetched and decoded batch by batch.
+        Store each page and its last_uid before taking the next one; the
+        stored last_uid is the checkpoint the next call resumes from.
+    """
+    imap = session.get()
+    uidvalidity = session.uidvalidity
+
+    #typ, nums = imap.uid("SEARCH", "ALL")
+
+    if (last_validity == uidvalidity):
+        # incremental, only mails newer than the stored high-water UID
+        typ, nums = imap.uid("SEARCH", "UID", "{}:*".format(last_uid + 1))
+    else:
+        debug(_("Full resync (UIDVALIDITY {} => {})").format(
+            last_validity, uidvalidity))
+        last_uid = 0
+
+        today = py_today.Today()
+        #yesterday = today - "days=1"
+        since = today - Argument.get_since(Argument.args.since)
+
+        typ, nums = imap.uid("SEARCH", "SINCE", since.format_time(
+            format="%d-%b-%Y"))
+
+    # 'n:*' always matches the highest UID, even if it is below n
+    uids = sorted([int(u) for u in nums[0].split() if (int(u) > last_uid)])
+    uids = [str(u) for u in uids]
+
+    page_size = int(params['imap_page_size']) or len(uids) or 1
+    max_pages = int(params['imap_max_pages'])
+    batch_size = int(params['imap_batch_size']) or 1
+
+    depth = 1
+    if (Argument.args.engine == "pipeline"):
+        depth = int(params['imap_pipeline_depth']) or 1
+
+    def pages():
+        if ((not uids) and last_validity != uidvalidity):
+            # empty window, start from the next mail to come
+            typ, data = imap.status(quote_mailbox(session.mailbox), "(UIDNEXT)")
+            m = re.search(r"UIDNEXT (\d+)", data[0] or "")
+            if (m):
+                yield (int(m.group(1)) - 1, iter([]))
+            # else no checkpoint, the next call resyncs the window again
+
+        total = (len(uids) + page_size - 1) // page_size
+        for n, page in enumerate(chunks(uids, page_size)):
+            if (max_pages and n >= max_pages):
+                # to be continued on next tick
+                break
+
+            debug(_("Page {} / {}").format(n + 1, total))
+
+            # fetch => decode => parse date, nothing is held beyond one batch
+            yield (int(page[-1]), parse_dates(decode_headers(
+                fetch_headers(imap, page, batch_size, depth))))
+
+    return (uidvalidity, pages())
+
 
-    close_table(conn)
+def load_imap(params=None, session=None, storage=None):
+    keep = bool(session)
+    if (not keep):
+        session = IMAPSession(params)
+
+    own = not storage
+    storage = storage or get_storage(params)
+    conn = storage.get()
+
+    last_validity, last_uid = get_sync_state(conn, session.key, db=storage.db)
+    uidvalidity, pages = fetch_imap(params, session, last_validity, last_uid)
+
+    count = 0
+    for last_uid, rows in pages:
+        # rows are written batch by batch while they are fetched
+        stats = insert_many_into_table(conn, rows, db=storage.db,
+                                       batch_size=int(params['db_batch_size']),
+                                       tz_name=params['rollup_timezone'])
+        count = count + sum(stats.values())
+
+        # checkpoint
+        set_sync_state(conn, session.key, uidvalidity, last_uid, db=storage.db)
+        conn.commit()
+
+    if (not keep):
+        session.close()
+
+    storage.put(conn)
+    if (own):
+        storage.close()
 
     debug(_("Total = {}").format(count))
 
 
-def fetch_mail(params=None, sch=None):
+def get_sessions(params=None):
+    """Get one IMAP session per configured account and folder"""
+    sessions = []
+    for account in get_accounts(params):
+        for folder in account['folders']:
+            sessions.append(IMAPSession(params, folder, account))
+
+    return sessions
+
+
+def load_imap_all(params=None, sessions=None, pool=None, storage=None):
+    """
+        Sync all mailboxes in parallel with the thread pool.
+        Workers only talk to IMAP and hand over batches of rows through a
+        bounded queue; rows are written by the calling thread.
+    """
+    own = not storage
+    storage = storage or get_storage(params)
+    conn = storage.get()
+
+    batch_size = int(params['db_batch_size'])
+    queue = Queue.Queue(maxsize=int(params['db_queue_size']))
+
+    def worker(session, last_validity, last_uid):
+        try:
+            uidvalidity, pages = fetch_imap(
+                params, session, last_validity, last_uid)
+
+            for last_uid, rows in pages:
+                for batch in chunks(rows, batch_size):
+                    queue.put(('rows', session, batch))
+
+                queue.put(('page', session, (uidvalidity, last_uid)))
+
+            queue.put(('done', session, None))
+        except Exception, e:
+            queue.put(('error', session, e))
+
+    for session in sessions:
+        last_validity, last_uid = get_sync_state(conn, session.key, db=storage.db)
+        pool.apply_async(worker, (session, last_validity, last_uid))
+
+    counts = dict([(session.key, 0) for session in sessions])
+    running = len(sessions)
+    while (running):
+        kind, session, data = queue.get()
+
+        if (kind == 'rows'):
+            insert_many_into_table(conn, data, db=storage.db,
+                                   batch_size=batch_size,
+                                   tz_name=params['rollup_timezone'])
+            counts[session.key] = counts[session.key] + len(data)
+            continue
+
+        if (kind == 'page'):
+            # checkpoint, mails up to last_uid are stored now
+            uidvalidity, last_uid = data
+            set_sync_state(conn, session.key, uidvalidity, last_uid,
+                           db=storage.db)
+            conn.commit()
+            continue
+
+        running = running - 1
+
+        if (kind == 'done'):
+            debug(_("Total = {}").format(counts[session.key]) +
+                  " ({})".format(session.key))
+        else:
+            # e.g. a missing folder, the others go on, reconnect next tick
+            debug(_("Sync failed ({})").format(repr(data)) +
+                  " ({})".format(session.key))
+            session.reset()
+
+    storage.put(conn)
+    if (own):
+        storage.close()
+
+
+def fetch_mail(params=None, sch=None, sessions=None, pool=None, storage=None):
     debug(_("Fetch mail and store ({})...").format(time.strftime("%F %T")))
 
-    # every 180 seconds
-    sch.enter(180, 1, fetch_mail, (params, sch))
+    load_imap_all(params=params, sessions=sessions, pool=pool,
+                  storage=storage)
+    # load_maildir(params=params, storage=storage)
+    # load_mbox(params=params, storage=storage)
+
+    debug(_("Header cache: {hits} hits, {misses} misses, {size} entries").format(
+        **header_cache.stats()))
+
+    # every 180 seconds, or as soon as new mail arrives
+    delay = 180
+    # IDLE watches a single mailbox only
+    if (len(sessions) == 1 and int(params['imap_idle'])):
+        session = sessions[0]
+        try:
+            # IDLE has already waited up to 'delay' seconds
+            session.idle(timeout=delay)
+            delay = 0
+        except (imaplib.IMAP4.error, socket.error), e:
+            debug(_("IMAP session lost ({})").format(e))
+            session.reset()
 
-    load_imap(params=params)
-    # load_maildir(params=params)
-    # load_mbox(params=params)
+    sch.enter(delay, 1, fetch_mail, (params, sch, sessions, pool, storage))
 
 
 def main():
@@ -409,9 +1770,32 @@ def main():
     params = get_config()
 
     logging.basicConfig(level=logging.DEBUG)
+
+    # schema is created once here
+    storage = get_storage(params)
+
+    if (Argument.args.rebuild_rollups):
+        conn = storage.get()
+        count = rebuild_rollups(conn.cursor(), db=storage.db,
+                                tz_name=params['rollup_timezone'])
+        debug(_("Rollups rebuilt from {} messages").format(count))
+        storage.put(conn)
+        storage.close()
+        return
+
+    sessions = get_sessions(params)
+    pool = multiprocessing.pool.ThreadPool(
+        min(int(params['imap_workers']), len(sessions)))
+
     sch = sched.scheduler(time.time, time.sleep)
-    sch.enter(0, 1, fetch_mail, (params, sch))
-    sch.run()
+    sch.enter(0, 1, fetch_mail, (params, sch, sessions, pool, storage))
+    try:
+        sch.run()
+    finally:
+        pool.close()
+        for session in sessions:
+            session.close()
+        storage.close()
 
 if __name__ == '__main__':
     main()
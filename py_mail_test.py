@@ -0,0 +1,810 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#=========================================================================
+#
+#         FILE: py_mail_test.py
+#
+#        USAGE: ./py_mail_test.py
+#
+#  DESCRIPTION: Unit test for py_mail helpers
+#
+#      OPTIONS: ---
+# REQUIREMENTS: ---
+#         BUGS: ---
+#        NOTES: ---
+#       AUTHOR: SHIE, Li-Yi (lyshie), lyshie@mx.nthu.edu.tw
+# ORGANIZATION:
+#      VERSION: 1.0
+#      CREATED: 2014-11-12 10:21:05
+#     REVISION: ---
+#=========================================================================
+
+import unittest
+import argparse
+import py_mail
+import os
+import shutil
+import sqlite3
+import tempfile
+import imaplib
+import time
+
+
+class PipelinedIMAP(object):
+
+    """Record tagged commands, answer them when completed"""
+
+    def __init__(self):
+        self.untagged_responses = {}
+        self.pending = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _command(self, name, command, uids, query):
+        tag = "A{}".format(len(self.pending))
+        self.pending[tag] = uids
+        self.in_flight = self.in_flight + 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return tag
+
+    def _command_complete(self, name, tag):
+        self.in_flight = self.in_flight - 1
+        for uid in self.pending[tag].split(","):
+            self.untagged_responses.setdefault("FETCH", []).extend(
+                [("1 (UID {} BODY[HEADER] {{3}}".format(uid), uid), ")"])
+        return ("OK", [None])
+
+
+class MailboxIMAP(object):
+
+    """Mailbox with the given UIDs, answer SEARCH and UID FETCH"""
+
+    def __init__(self, uids, uidnext=None):
+        self.uids = uids
+        self.uidnext = uidnext
+        self.fetched = []
+
+    def status(self, mailbox, names):
+        if (self.uidnext is None):
+            return ("OK", ["{} (MESSAGES {})".format(mailbox, len(self.uids))])
+
+        return ("OK", ["{} (UIDNEXT {})".format(mailbox, self.uidnext)])
+
+    def uid(self, command, *args):
+        if (command == "SEARCH"):
+            return ("OK", [" ".join([str(u) for u in self.uids])])
+
+        data = []
+        for part in args[0].split(","):
+            a, b = (part.split(":") + [part])[:2]
+            for u in range(int(a), int(b) + 1):
+                self.fetched.append(u)
+                data.extend([("1 (UID {} BODY[HEADER] {{12}}".format(u),
+                              "Subject: {}\r\n\r\n".format(u)), ")"])
+
+        return ("OK", data)
+
+
+class MailboxSession(object):
+
+    def __init__(self, uids):
+        self.imap = MailboxIMAP(uids)
+        self.uidvalidity = 1
+        self.mailbox = "INBOX"
+        self.key = "lyshie@localhost/INBOX"
+        self.resets = 0
+
+    def get(self):
+        return self.imap
+
+    def reset(self):
+        self.resets = self.resets + 1
+
+
+class BrokenSession(MailboxSession):
+
+    def __init__(self):
+        MailboxSession.__init__(self, [])
+        self.key = "lyshie@localhost/No Such"
+
+    def get(self):
+        raise TypeError("int() argument must be a string or a number")
+
+
+class NoFolderIMAP(imaplib.IMAP4):
+
+    """Server without the selected folder"""
+
+    selected = None
+    shutdowns = 0
+
+    def __init__(self, host=''):
+        pass
+
+    def login(self, user, password):
+        return ("OK", [None])
+
+    def select(self, mailbox='INBOX', readonly=False):
+        NoFolderIMAP.selected = mailbox
+        return ("NO", ["Mailbox does not exist"])
+
+    def shutdown(self):
+        NoFolderIMAP.shutdowns = NoFolderIMAP.shutdowns + 1
+
+
+class BadLoginIMAP(NoFolderIMAP):
+
+    """Server refusing the login"""
+
+    def login(self, user, password):
+        raise self.error("LOGIN failed")
+
+
+class KeepaliveSocket(object):
+
+    def __init__(self):
+        self.timeouts = []
+
+    def settimeout(self, timeout):
+        self.timeouts.append(timeout)
+
+
+class KeepaliveIMAP(object):
+
+    """IDLE server sending an untagged OK every 'interval' seconds"""
+
+    capabilities = ("IMAP4REV1", "IDLE")
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.sock = KeepaliveSocket()
+        self.sent = []
+
+    def noop(self):
+        return ("OK", [None])
+
+    def _new_tag(self):
+        return "A1"
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def readline(self):
+        if (self.sent[-1] == "DONE\r\n"):
+            return "A1 OK IDLE terminated\r\n"
+        if (len(self.sock.timeouts) == 0):
+            return "+ idling\r\n"
+
+        time.sleep(self.interval)
+        return "* OK still here\r\n"
+
+
+class FulltextCursor(object):
+
+    """MySQL cursor without the index, ALTER raises 'error' if given"""
+
+    def __init__(self, stopword=1, error=None):
+        self.stopword = stopword
+        self.error = error
+        self.statements = []
+        self.row = None
+
+    def execute(self, sql, args=None):
+        sql = " ".join(sql.split())
+        self.row = None
+        if (sql.startswith("ALTER")):
+            self.statements.append("ALTER")
+            if (self.error):
+                raise self.error
+        else:
+            self.statements.append(sql)
+            if (sql.startswith("SELECT @@SESSION")):
+                self.row = (self.stopword, )
+
+    def fetchone(self):
+        return self.row
+
+
+class FetchTestCase(unittest.TestCase):
+
+    def test_compress_uids(self):
+        expected = '1:3,7,9:10'
+        result = py_mail.compress_uids(['10', '2', '1', '9', '3', '7'])
+
+        self.assertEqual(expected, result)
+
+    def test_chunks(self):
+        expected = [['1', '2'], ['3', '4'], ['5']]
+        result = list(py_mail.chunks(['1', '2', '3', '4', '5'], 2))
+
+        self.assertEqual(expected, result)
+
+    def test_parse_fetch_headers(self):
+        expected = {'1001': 'Subject: a\r\n\r\n', '1002': 'Subject: b\r\n\r\n'}
+        data = [('1 (UID 1001 BODY[HEADER.FIELDS (SUBJECT DATE FROM)] {14}',
+                 'Subject: a\r\n\r\n'),
+                ')',
+                ('2 (BODY[HEADER.FIELDS (SUBJECT DATE FROM)] {14}',
+                 'Subject: b\r\n\r\n'),
+                ' UID 1002)']
+        result = py_mail.parse_fetch_headers(data)
+
+        self.assertEqual(expected, result)
+
+    def test_fetch_headers_pipelined(self):
+        expected = dict([(str(u), str(u)) for u in [1, 3, 5, 7, 9, 11, 13]])
+
+        imap = PipelinedIMAP()
+        uids = [str(u) for u in [1, 3, 5, 7, 9, 11, 13]]
+        result = dict(py_mail.fetch_headers(imap, uids, batch_size=2, depth=3))
+
+        self.assertEqual(expected, result)
+        self.assertEqual(3, imap.max_in_flight)
+        self.assertEqual(0, imap.in_flight)
+
+    def test_decode_and_parse_dates(self):
+        expected = [(u'Hello', 1414050717, u'lyshie@mx.nthu.edu.tw'),
+                    (u'', 0, u'')]
+
+        items = [('1001', 'Subject: Hello\r\n'
+                          'Date: Thu, 23 Oct 2014 15:51:57 +0800\r\n'
+                          'From: "SHIE, Li-Yi" <lyshie@mx.nthu.edu.tw>\r\n\r\n'),
+                 ('1002', '')]
+        result = list(py_mail.parse_dates(py_mail.decode_headers(items)))
+
+        self.assertEqual(expected, result)
+
+    def test_fetch_imap_pages(self):
+        expected = [(3, [u'1', u'2', u'3']), (6, [u'4', u'5', u'6'])]
+
+        py_mail.Argument.args = argparse.Namespace(since="days=2",
+                                                   engine="sync")
+        params = {'imap_page_size': '3', 'imap_max_pages': '2',
+                  'imap_batch_size': '2'}
+        session = MailboxSession([1, 2, 3, 4, 5, 6, 7])
+        uidvalidity, pages = py_mail.fetch_imap(params, session, 1, 0)
+        result = [(last_uid, sorted([r[0] for r in rows]))
+                  for last_uid, rows in pages]
+
+        self.assertEqual(expected, result)
+        self.assertEqual([1, 2, 3, 4, 5, 6], sorted(session.imap.fetched))
+
+    def test_fetch_imap_resume(self):
+        expected = [(7, [u'7'])]
+
+        py_mail.Argument.args = argparse.Namespace(since="days=2",
+                                                   engine="sync")
+        params = {'imap_page_size': '3', 'imap_max_pages': '2',
+                  'imap_batch_size': '2'}
+        session = MailboxSession([6, 7])
+        uidvalidity, pages = py_mail.fetch_imap(params, session, 1, 6)
+        result = [(last_uid, [r[0] for r in rows]) for last_uid, rows in pages]
+
+        self.assertEqual(expected, result)
+
+    def test_fetch_imap_uidnext(self):
+        py_mail.Argument.args = argparse.Namespace(since="days=2",
+                                                   engine="sync")
+        params = {'imap_page_size': '3', 'imap_max_pages': '2',
+                  'imap_batch_size': '2'}
+
+        # empty window on a full resync, checkpoint at UIDNEXT - 1
+        session = MailboxSession([])
+        session.imap.uidnext = 8
+        uidvalidity, pages = py_mail.fetch_imap(params, session, None, 0)
+        self.assertEqual([(7, [])], [(u, list(rows)) for u, rows in pages])
+
+        # UIDNEXT left out of the STATUS reply, no checkpoint
+        session = MailboxSession([])
+        uidvalidity, pages = py_mail.fetch_imap(params, session, None, 0)
+        self.assertEqual([], list(pages))
+
+
+class DecodeTestCase(unittest.TestCase):
+
+    def test_ascii(self):
+        expected = u'Hello World'
+        result = py_mail.decode_header('Hello\r\n World')
+
+        self.assertEqual(expected, result)
+
+    def test_encoded(self):
+        expected = u'\u6e2c\u8a66'
+
+        stats = py_mail.header_cache.stats()
+        result = py_mail.decode_header('=?big5?B?tPq41Q==?=')
+        result2 = py_mail.decode_header('=?big5?B?tPq41Q==?=')
+
+        self.assertEqual(expected, result)
+        self.assertEqual(expected, result2)
+        self.assertEqual(stats['hits'] + 1, py_mail.header_cache.stats()['hits'])
+
+    def test_lru(self):
+        expected = [None, 2, 3]
+
+        cache = py_mail.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('b')
+        cache.put('c', 3)
+        result = [cache.get('a'), cache.get('b'), cache.get('c')]
+
+        self.assertEqual(expected, result)
+
+
+class AccountTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {'imap_host': 'imap.mx.nthu.edu.tw',
+                       'imap_username': 'lyshie',
+                       'imap_password': 'secret',
+                       'imap_accounts': '',
+                       'imap_folders': 'INBOX'}
+
+    def test_default_account(self):
+        expected = [{'host': 'imap.mx.nthu.edu.tw', 'username': 'lyshie',
+                     'password': 'secret', 'folders': ['INBOX']}]
+        result = py_mail.get_accounts(self.params)
+
+        self.assertEqual(expected, result)
+
+    def test_quote_mailbox(self):
+        self.assertEqual('"Sent Items"', py_mail.quote_mailbox('Sent Items'))
+        self.assertEqual('"a\\"b"', py_mail.quote_mailbox('a"b'))
+        self.assertEqual('"INBOX"', py_mail.quote_mailbox('"INBOX"'))
+
+    def test_select_missing_folder(self):
+        imap4 = py_mail.imaplib.IMAP4
+        py_mail.imaplib.IMAP4 = NoFolderIMAP
+        try:
+            session = py_mail.IMAPSession(self.params, mailbox="No Such")
+            self.assertRaises(imap4.error, session.connect)
+        finally:
+            py_mail.imaplib.IMAP4 = imap4
+
+        self.assertEqual('"No Such"', NoFolderIMAP.selected)
+
+    def test_connect_shutdown(self):
+        imap4 = py_mail.imaplib.IMAP4
+        NoFolderIMAP.shutdowns = 0
+        try:
+            for cls in [NoFolderIMAP, BadLoginIMAP]:
+                py_mail.imaplib.IMAP4 = cls
+                session = py_mail.IMAPSession(self.params)
+                self.assertRaises(imap4.error, session.connect)
+        finally:
+            py_mail.imaplib.IMAP4 = imap4
+
+        self.assertEqual(2, NoFolderIMAP.shutdowns)
+
+    def test_idle_deadline(self):
+        session = py_mail.IMAPSession(self.params)
+        session.imap = KeepaliveIMAP(0.05)
+
+        start = time.time()
+        self.assertFalse(session.idle(timeout=0.2))
+
+        # keepalives do not restart the timeout
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(None, session.imap.sock.timeouts[-1])
+        self.assertEqual(["A1 IDLE\r\n", "DONE\r\n"], session.imap.sent)
+
+    def test_accounts(self):
+        expected = [('lyshie', ['INBOX']), ('alice', ['INBOX', 'Lists'])]
+
+        self.params['imap_accounts'] = 'lyshie, alice'
+        self.params['imap_alice_username'] = 'alice'
+        self.params['imap_alice_folders'] = 'INBOX, Lists'
+        result = [(a['username'], a['folders'])
+                  for a in py_mail.get_accounts(self.params)]
+
+        self.assertEqual(expected, result)
+
+
+class MaildirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        for sub in ["new", "cur", "tmp"]:
+            os.mkdir(os.path.join(self.dirname, sub))
+
+        for filename, subject in [("new/1414050717.M1.host", "one"),
+                                  ("cur/1414050718.M2.host:2,S", "two")]:
+            with open(os.path.join(self.dirname, filename), "wb") as f:
+                f.write("Subject: {}\r\n"
+                        "Date: Thu, 23 Oct 2014 15:51:57 +0800\r\n"
+                        "From: lyshie@mx.nthu.edu.tw\r\n"
+                        "\r\n"
+                        "Subject: not a header\r\n".format(subject))
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_scan_and_parse(self):
+        expected = [('1414050717.M1.host', u'one'),
+                    ('1414050718.M2.host', u'two')]
+
+        entries = py_mail.scan_maildir(self.dirname)
+        result = sorted([(r[0], r[3][0])
+                         for r in map(py_mail.parse_maildir_file, entries)])
+
+        self.assertEqual(expected, result)
+
+    def test_skip_indexed(self):
+        expected = ['1414050718.M2.host']
+
+        entries = py_mail.scan_maildir(self.dirname)
+        index = dict([(e[0], (e[2], e[3])) for e in entries
+                      if (e[0] == '1414050717.M1.host')])
+        result = [e[0] for e in py_mail.scan_maildir(self.dirname, index)]
+
+        self.assertEqual(expected, result)
+
+
+class MboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".mbox")
+        os.close(fd)
+
+        self.write(["one", "two", "three"])
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def write(self, subjects):
+        with open(self.filename, "wb") as f:
+            for subject in subjects:
+                f.write("From lyshie@mx.nthu.edu.tw Thu Oct 23 15:51:57 2014\n"
+                        "Subject: {}\n"
+                        "From: lyshie@mx.nthu.edu.tw\n"
+                        "\n"
+                        "body\n"
+                        "\n".format(subject))
+
+    def test_scan(self):
+        expected = [u'one', u'two', u'three']
+
+        rows = py_mail.parse_dates(py_mail.decode_headers(
+            py_mail.scan_mbox(self.filename)))
+        result = [r[0] for r in rows]
+
+        self.assertEqual(expected, result)
+
+    def test_scan_from_offset(self):
+        expected = [u'two', u'three']
+
+        offsets = [o for o, raw in py_mail.scan_mbox(self.filename)]
+        rows = py_mail.parse_dates(py_mail.decode_headers(
+            py_mail.scan_mbox(self.filename, offsets[1])))
+        result = [r[0] for r in rows]
+
+        self.assertEqual(expected, result)
+
+    def test_rewritten(self):
+        expected = [u'five', u'three', u'two']
+
+        fd, database = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        params = py_mail.get_config(os.devnull)
+        params['sqlite3_database'] = database
+        params['db_engine'] = 'sqlite3'
+        params['mbox_path'] = self.filename
+        storage = py_mail.get_storage(params)
+        try:
+            py_mail.load_mbox(params, storage)
+
+            # 'one' expunged, 'five' now spans the stored offset of 'three'
+            self.write(["two", "five", "three"])
+            py_mail.load_mbox(params, storage)
+
+            conn = storage.get()
+            result = [r[0] for r in conn.execute(
+                "SELECT subject FROM message WHERE subject != 'one' ORDER BY subject")]
+            offset = py_mail.get_mbox_offset(conn, self.filename)
+            storage.put(conn)
+        finally:
+            storage.close()
+            os.remove(database)
+
+        offsets = [o for o, raw in py_mail.scan_mbox(self.filename)]
+        self.assertEqual(expected, result)
+        self.assertEqual(offsets[-1], offset)
+
+    def test_scan_misaligned(self):
+        expected = [u'one', u'two', u'three']
+
+        rows = py_mail.parse_dates(py_mail.decode_headers(
+            py_mail.scan_mbox(self.filename, 10)))
+        result = [r[0] for r in rows]
+
+        self.assertEqual(expected, result)
+
+
+class TableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.params = py_mail.get_config(os.devnull)
+        self.params['sqlite3_database'] = self.filename
+        py_mail.create_table(db='sqlite3', params=self.params)
+        self.conn = py_mail.open_table(db='sqlite3', params=self.params)
+
+    def tearDown(self):
+        py_mail.close_table(self.conn)
+        os.remove(self.filename)
+
+    def test_insert_many(self):
+        expected = [('a', 1, 'x@example.com'), ('b', 2, 'y@example.com')]
+
+        rows = [('a', 1, 'x@example.com'), ('b', 2, 'y@example.com'),
+                ('a', 1, 'x@example.com')]
+        stats = py_mail.insert_many_into_table(self.conn, rows, batch_size=2)
+        result = self.conn.execute(
+            "SELECT subject, date, s_from FROM message ORDER BY date").fetchall()
+
+        self.assertEqual({'new': 2, 'updated': 0, 'skipped': 1}, stats)
+        self.assertEqual(expected, result)
+
+    def test_upsert(self):
+        expected = [('a', 1, 'z@example.com'), ('b', 2, 'y@example.com')]
+
+        rows = [('a', 1, 'x@example.com'), ('b', 2, 'y@example.com')]
+        py_mail.insert_many_into_table(self.conn, rows)
+        rows = [('a', 1, 'z@example.com'), ('b', 2, 'y@example.com')]
+        stats = py_mail.insert_many_into_table(self.conn, rows)
+        result = self.conn.execute(
+            "SELECT subject, date, s_from FROM message ORDER BY date").fetchall()
+
+        self.assertEqual({'new': 0, 'updated': 1, 'skipped': 1}, stats)
+        self.assertEqual(expected, result)
+
+    def test_stats(self):
+        rows = [('a', 1, 'x@example.com'), ('b', 2, 'y@example.com')]
+        py_mail.insert_many_into_table(self.conn, rows)
+        py_mail.insert_many_into_table(self.conn, rows)
+        count, version = self.conn.execute(
+            "SELECT count, version FROM message_stats WHERE id = 1").fetchone()
+
+        self.assertEqual(2, count)
+        self.assertEqual(2, version)
+
+    def test_rollups(self):
+        day = 1414080000    # 2014-10-24 00:00:00 +0800
+        expected = [(day - 86400, 'x@example.com', 1),
+                    (day, 'x@example.com', 0),
+                    (day, 'y@example.com', 1),
+                    (day, 'z@example.com', 1)]
+
+        rows = [('a', day + 10, 'x@example.com'),
+                ('b', day + 20, 'y@example.com'),
+                ('c', day - 10, 'x@example.com')]
+        py_mail.insert_many_into_table(self.conn, rows)
+        rows = [('a', day + 10, 'z@example.com')]
+        py_mail.insert_many_into_table(self.conn, rows)
+        result = self.conn.execute(
+            "SELECT day, s_from, count FROM message_daily ORDER BY day, s_from").fetchall()
+        total = self.conn.execute(
+            "SELECT day, count FROM message_daily_total ORDER BY day").fetchall()
+
+        self.assertEqual(expected, result)
+        self.assertEqual([(day - 86400, 1), (day, 2)], total)
+
+    def test_rollup_deltas(self):
+        day = 1414080000
+        expected = ({(day, u'x@example.com'): -1, (day, u'z@example.com'): 1,
+                     (day - 86400, u'x@example.com'): 1},
+                    {day - 86400: 1})
+
+        before = {1: (day + 10, u'x@example.com'),
+                  2: (day + 20, u'y@example.com')}
+        after = {1: (day + 10, u'z@example.com'),
+                 2: (day + 20, u'y@example.com'),
+                 3: (day - 10, u'x@example.com')}
+        daily, total = py_mail.get_rollup_deltas(before, after)
+
+        self.assertEqual(expected, (dict(daily), dict(total)))
+
+    def test_rollup_timezone(self):
+        day = 1414080000
+        rows = [('a', day + 10, 'x@example.com')]
+        py_mail.insert_many_into_table(self.conn, rows)
+
+        self.params['rollup_timezone'] = 'UTC'
+        py_mail.create_table(db='sqlite3', params=self.params, conn=self.conn)
+        result = self.conn.execute("SELECT day FROM message_daily_total").fetchall()
+
+        self.assertEqual('UTC', py_mail.get_rollup_timezone(self.conn.cursor()))
+        # 2014-10-23 16:00:10 UTC
+        self.assertEqual([(day - 16 * 3600, )], result)
+
+    def test_rebuild_rollups(self):
+        day = 1414080000
+        rows = [(u'\u90f5\u4ef6', day + 10, u'\u674e <x@example.com>'),
+                ('b', day + 20, 'y@example.com'),
+                ('c', day - 10, None)]
+        py_mail.insert_many_into_table(self.conn, rows)
+        py_mail.insert_many_into_table(self.conn, rows)
+        query = "SELECT day, s_from, count FROM message_daily WHERE count ORDER BY day, s_from"
+        expected = self.conn.execute(query).fetchall()
+
+        count = py_mail.rebuild_rollups(self.conn.cursor())
+        result = self.conn.execute(query).fetchall()
+
+        self.assertEqual(3, count)
+        self.assertEqual(3, len(result))
+        self.assertEqual(expected, result)
+
+    def test_parse_mysql_info(self):
+        expected = {'records': 3, 'duplicates': 1, 'warnings': 0}
+        result = py_mail.parse_mysql_info("Records: 3  Duplicates: 1  Warnings: 0")
+
+        self.assertEqual(expected, result)
+
+    def test_upsert_counts(self):
+        # 3 new, 1 updated, 6 unchanged
+        expected = (3, 1)
+        result = py_mail.get_upsert_counts(
+            5, "Records: 10  Duplicates: 1  Warnings: 0")
+
+        self.assertEqual(expected, result)
+
+    def test_upsert_counts_unchanged(self):
+        expected = (0, 0)
+        result = py_mail.get_upsert_counts(
+            0, "Records: 10  Duplicates: 0  Warnings: 0")
+
+        self.assertEqual(expected, result)
+
+    def test_create_fulltext(self):
+        expected = ["SET SESSION innodb_ft_enable_stopword = OFF",
+                    "ALTER", "SET SESSION innodb_ft_enable_stopword = 0"]
+
+        cur = FulltextCursor(stopword=0)
+        result = py_mail.create_fulltext(cur, db='mysql')
+
+        self.assertTrue(result)
+        self.assertEqual(expected, cur.statements[2:])
+
+    def test_create_fulltext_unsupported(self):
+        expected = "SET SESSION innodb_ft_enable_stopword = 1"
+
+        cur = FulltextCursor(stopword=1, error=py_mail.MySQLdb.Error(
+            "Function 'ngram' is not defined"))
+        result = py_mail.create_fulltext(cur, db='mysql')
+
+        self.assertFalse(result)
+        self.assertEqual(expected, cur.statements[-1])
+        self.assertFalse(py_mail.create_fulltext(self.conn.cursor()))
+
+    def test_migrate(self):
+        expected = [(1, 'a', 1, 'x@example.com')]
+
+        os.remove(self.filename)
+        conn = sqlite3.connect(self.filename)
+        conn.execute('''
+            CREATE TABLE message
+            (
+                subject TEXT,
+                date    TEXT,
+                s_from  TEXT,
+                UNIQUE  (subject, date)
+            )
+        ''')
+        conn.execute("INSERT INTO message VALUES ('a', '1', 'x@example.com')")
+        conn.commit()
+
+        py_mail.create_table(db='sqlite3', params=self.params, conn=conn)
+        result = conn.execute("SELECT id, subject, date, s_from FROM message").fetchall()
+        version = py_mail.get_schema_version(conn.cursor())
+        indexes = [r[1] for r in conn.execute("PRAGMA index_list(message)")]
+        conn.close()
+
+        self.assertEqual(expected, result)
+        self.assertEqual(py_mail.schema_version, version)
+        self.assertTrue('idx_date' in indexes)
+        self.assertTrue('idx_from_date' in indexes)
+
+    def test_maildir_index(self):
+        expected = {'1414050717.M1.host': (1414050717, 1024)}
+
+        py_mail.set_maildir_index(
+            self.conn, [('1414050717.M1.host', 1414050717, 1024)])
+        result = py_mail.get_maildir_index(self.conn)
+
+        self.assertEqual(expected, result)
+
+    def test_empty(self):
+        expected = (None, 0)
+        result = py_mail.get_sync_state(self.conn, "INBOX")
+
+        self.assertEqual(expected, result)
+
+    def test_set_and_get(self):
+        expected = (1414050717, 1502)
+
+        py_mail.set_sync_state(self.conn, "INBOX", 1414050717, 1001)
+        py_mail.set_sync_state(self.conn, "INBOX", 1414050717, 1502)
+        result = py_mail.get_sync_state(self.conn, "INBOX")
+
+        self.assertEqual(expected, result)
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.params = py_mail.get_config(os.devnull)
+        self.params['sqlite3_database'] = self.filename
+        self.params['db_engine'] = 'sqlite3'
+        self.params['db_pool_size'] = '1'
+        self.storage = py_mail.get_storage(self.params)
+
+    def tearDown(self):
+        self.storage.close()
+        os.remove(self.filename)
+
+    def test_engine(self):
+        self.assertTrue(isinstance(self.storage, py_mail.SQLiteStorage))
+        self.assertEqual('sqlite3', self.storage.db)
+
+    def test_pragmas(self):
+        expected = ('wal', 1, 5000)
+
+        conn = self.storage.get()
+        result = (conn.execute("PRAGMA journal_mode").fetchone()[0],
+                  conn.execute("PRAGMA synchronous").fetchone()[0],
+                  conn.execute("PRAGMA busy_timeout").fetchone()[0])
+        self.storage.put(conn)
+
+        self.assertEqual(expected, result)
+
+    def test_load_imap_all_error(self):
+        py_mail.Argument.args = argparse.Namespace(since="days=2",
+                                                   engine="sync")
+        self.params['imap_page_size'] = '2'
+        self.params['db_queue_size'] = '1'
+        good = MailboxSession([1, 2, 3, 4, 5])
+        broken = BrokenSession()
+        pool = py_mail.multiprocessing.pool.ThreadPool(2)
+        try:
+            py_mail.load_imap_all(self.params, [broken, good], pool,
+                                  self.storage)
+        finally:
+            pool.close()
+
+        conn = self.storage.get()
+        count = conn.execute("SELECT COUNT(*) FROM message").fetchone()[0]
+        state = py_mail.get_sync_state(conn, good.key, db=self.storage.db)
+        self.storage.put(conn)
+
+        self.assertEqual(1, broken.resets)
+        self.assertEqual(5, count)
+        self.assertEqual((1, 5), state)
+
+    def test_pool(self):
+        conn = self.storage.get()
+        py_mail.set_sync_state(conn, "INBOX", 1, 2, db=self.storage.db)
+        self.storage.put(conn)
+
+        conn2 = self.storage.get()
+        result = py_mail.get_sync_state(conn2, "INBOX", db=self.storage.db)
+        self.storage.put(conn2)
+
+        self.assertTrue(conn is conn2)
+        self.assertEqual((1, 2), result)
+
+
+def main():
+    suite = unittest.TestSuite()
+    for case in [FetchTestCase, DecodeTestCase, AccountTestCase,
+                 MaildirTestCase, MboxTestCase, TableTestCase,
+                 StorageTestCase]:
+        suite.addTests(unittest.TestLoader().loadTestsFromTestCase(case))
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,7 @@
 #
 #         FILE: web.py
 #
-#        USAGE: ./web.py
+#        USAGE: ./web.py [--debug]
 #
 #  DESCRIPTION: Simple RESTful API
 #
@@ -25,9 +25,33 @@ from flask import Flask
 from flask import request
 from flask import jsonify
 from flask import render_template
+from flask import Response
+from flask import stream_with_context
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy import exc
+from sqlalchemy.pool import Pool
+import argparse
 import getpass
 import ConfigParser
+import base64
+import datetime
+import time
+import json
+import csv
+import cStringIO
+import itertools
+import collections
+import functools
+import hashlib
+import tempfile
+import threading
+import calendar
+import sys
+
+# py_today.py lives next to py_mail.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import py_today
 
 
 def get_default_config(filename=""):
@@ -50,9 +74,28 @@ def get_config(filename=get_default_config()):
               'mysql_password': None,
               'mysql_table': 'maildir',
               'mysql_host': 'localhost',
+              'mysql_pool_size': '10',
+              'mysql_max_overflow': '20',
+              'mysql_pool_recycle': '3600',
+              'mysql_pool_pre_ping': '1',
+              'cache_info_ttl': '5',
+              'cache_backend': 'memory',
+              'cache_size': '1024',
+              'cache_path': os.path.join(tempfile.gettempdir(), 'py_mail_web'),
+              'export_chunk_size': '1000',
+              'batch_chunk_size': '500',
+              'batch_max_ids': '10000',
+              'report_timezone': 'Asia/Taipei',
+              'report_top': '10',
+              'report_days': '30',
+              'report_max_buckets': '1000',
+              'server_host': '0.0.0.0',
+              'server_port': '5000',
+              'server_workers': '4',
+              'server_threads': '8',
               }
 
-    for sec in ['mysql']:
+    for sec in ['mysql', 'cache', 'server', 'export', 'batch', 'report']:
         if (config.has_section(sec)):
             for k in config.options(sec):
                 if (config.has_option(sec, k)):
@@ -65,9 +108,28 @@ params = get_config()
 password = params['mysql_password'] or getpass.getpass("MySQL Password: ")
 app.config[
     "SQLALCHEMY_DATABASE_URI"] = "mysql://{mysql_username}:{mysql_password}@{mysql_host}/{mysql_table}".format(**params)
+# per worker process, connections are opened lazily after fork
+app.config["SQLALCHEMY_POOL_SIZE"] = int(params['mysql_pool_size'])
+app.config["SQLALCHEMY_MAX_OVERFLOW"] = int(params['mysql_max_overflow'])
+app.config["SQLALCHEMY_POOL_RECYCLE"] = int(params['mysql_pool_recycle'])
 db = SQLAlchemy(app)
 
 
+@event.listens_for(Pool, "checkout")
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Pre-ping a pooled connection, replace it if MySQL has gone away"""
+    if (not int(params['mysql_pool_pre_ping'])):
+        return
+
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
 class Message(db.Model):
     __tablename__ = "message"
 
@@ -89,53 +151,398 @@ class Message(db.Model):
                 'date': self.date}
 
 
+# the schema does not change while running
+columns = [{'name': c.name, 'type': repr(c.type)}
+           for c in Message.__table__.columns]
+
+stats_cache = {'expires': 0, 'stats': None}
+
+
+def get_stats():
+    """
+        Get (count, version, updated) of the message table, maintained by
+        the ingester in 'message_stats', cached for 'info_ttl' seconds
+    """
+    now = time.time()
+
+    if (stats_cache['expires'] <= now):
+        try:
+            row = db.session.execute(
+                "SELECT count, version, updated FROM message_stats WHERE id = 1").fetchone()
+        except (exc.ProgrammingError, exc.OperationalError):
+            # no such table
+            db.session.rollback()
+            row = None
+
+        if (row):
+            stats = (int(row[0]), int(row[1]), int(row[2]))
+        else:
+            # ingester has not created it yet
+            stats = (Message.query.count(), 0, 0)
+
+        stats_cache['stats'] = stats
+        stats_cache['expires'] = now + int(params['cache_info_ttl'])
+
+    return stats_cache['stats']
+
+
+class MemoryCache(object):
+
+    """Bounded LRU of response bodies, private to a worker process"""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return None
+
+            # most recently used goes last
+            self.data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+
+            while (len(self.data) > self.size):
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class FileCache(object):
+
+    """Bounded LRU of response bodies in a directory, shared by workers"""
+
+    def __init__(self, path, size=1024):
+        self.path = path
+        self.size = size
+
+        if (not os.path.isdir(path)):
+            os.makedirs(path)
+
+    def filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename, "rb") as f:
+                value = f.read()
+            # mtime is the recency
+            os.utime(filename, None)
+            return value
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, value):
+        """Store the value, a failure only leaves it uncached"""
+        filename = self.filename(key)
+
+        # atomic against readers in other workers
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".")
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.rename(tmp, filename)
+
+            names = self.names()
+        except (IOError, OSError):
+            if (tmp):
+                self.remove(os.path.basename(tmp))
+            return
+
+        if (len(names) > self.size):
+            files = []
+            for n in names:
+                try:
+                    files.append(
+                        (os.path.getmtime(os.path.join(self.path, n)), n))
+                except OSError:
+                    pass
+            files.sort()
+            for mtime, n in files[:len(files) - self.size]:
+                self.remove(n)
+
+    def remove(self, name):
+        try:
+            os.unlink(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def names(self):
+        """Cached entries, without the temporary files of put()"""
+        return [n for n in os.listdir(self.path) if not n.startswith(".")]
+
+    def clear(self):
+        try:
+            names = self.names()
+        except OSError:
+            return
+
+        for n in names:
+            self.remove(n)
+
+
+def get_response_cache(params):
+    size = int(params['cache_size'])
+
+    if (params['cache_backend'] == "file"):
+        return FileCache(params['cache_path'], size)
+    elif (params['cache_backend'] == "memory"):
+        return MemoryCache(size)
+    else:
+        return None
+
+response_cache = get_response_cache(params)
+response_version = {'version': None}
+
+
+def cached_response(f):
+    """
+        Cache the JSON body of a view by path, query string and the data
+        version the ingester bumps in 'message_stats'
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if (response_cache is None):
+            return f(*args, **kwargs)
+
+        count, version, updated = get_stats()
+        if (response_version['version'] != version):
+            # drop pages of the previous version at once
+            if (response_version['version'] is not None):
+                response_cache.clear()
+            response_version['version'] = version
+
+        key = "{}:{}?{}".format(version, request.path.encode("utf-8"),
+                                "&".join(sorted(request.query_string.split("&"))))
+
+        body = response_cache.get(key)
+        if (body is not None):
+            return Response(body, mimetype="application/json")
+
+        response = f(*args, **kwargs)
+        if (isinstance(response, Response) and response.status_code == 200):
+            response_cache.put(key, response.get_data())
+
+        return response
+
+    return wrapper
+
+
 @app.route("/mail")
 def get_mail_info():
-    count = Message.query.count()
-    columns = [{'name': c.name, 'type': repr(c.type)}
-               for c in Message.__table__.columns]
+    count, version, updated = get_stats()
+
+    response = jsonify(count=count, columns=columns)
+    response.set_etag("{}-{}".format(version, count))
+    if (updated):
+        response.last_modified = datetime.datetime.utcfromtimestamp(updated)
+
+    # 304 Not Modified for If-None-Match / If-Modified-Since
+    return response.make_conditional(request)
+
+
+def encode_cursor(date, id):
+    """Opaque token of the last (date, id) on a sorted page"""
+    return base64.urlsafe_b64encode("{}:{}".format(date, id))
 
-    return jsonify(count=count, columns=columns)
+
+def decode_cursor(cursor):
+    try:
+        date, id = base64.urlsafe_b64decode(str(cursor)).split(":")
+        return (int(date), int(id))
+    except (TypeError, ValueError):
+        return None
+
+
+fulltext_cache = {'enabled': None}
+
+
+def has_fulltext():
+    """
+        Whether the ingester could create the FULLTEXT index (not on
+        MariaDB or MySQL < 5.7.6), checked once per worker
+    """
+    if (fulltext_cache['enabled'] is None):
+        try:
+            row = db.session.execute(
+                "SHOW INDEX FROM message WHERE Key_name = 'ft_subject'").fetchone()
+        except (exc.ProgrammingError, exc.OperationalError):
+            db.session.rollback()
+            row = None
+
+        fulltext_cache['enabled'] = bool(row)
+
+    return fulltext_cache['enabled']
+
+
+def get_fields(column=None):
+    """
+        Column names asked by '<column>' or '?fields=subject,date' without
+        repeats, None when any of them is not a column of the message table
+    """
+    if (column):
+        names = [column]
+    elif (request.args.get('fields')):
+        names = [n.strip() for n in request.args.get('fields').split(",")]
+    else:
+        return [c.name for c in Message.__table__.columns]
+
+    unique = []
+    for n in names:
+        if (n not in Message.__table__.columns):
+            return None
+        # a repeated column is selected once
+        if (n not in unique):
+            unique.append(n)
+
+    return unique
 
 
 @app.route("/mail/<int:row>/<int:count>")
 @app.route("/mail/<int:row>/<int:count>/<column>")
+@cached_response
 def get_row_count(row, column=None, count=1):
     sorted = request.args.get('sorted')
     keyword = request.args.get('keyword')
-    query = Message.query
+    cursor = request.args.get('cursor')
+    table = Message.__table__
     keywords = []
     result = []
+    bind = {}
+
+    names = get_fields(column)
+    if (not names):
+        return jsonify(error="unknown column")
+
+    # select tuples of only the asked columns (plus date, id for the
+    # cursor) instead of building ORM objects
+    selected = names + [n for n in ['date', 'id'] if n not in names]
+    query = db.select([table.c[n] for n in selected])
 
     if (keyword):
         keywords = [k.strip() for k in keyword.split(",")]
 
     if (keywords):
+        # ngram FULLTEXT index on subject (ngram_token_size = 2), created
+        # without stopwords by py_mail.create_fulltext() so that ASCII
+        # words match too, shorter keywords or no index fall back to LIKE
+        fulltext = []
+        enabled = has_fulltext()
         for k in keywords:
-            if (k):
-                query = query.filter(Message.subject.contains(k))
+            if (enabled and len(k) >= 2):
+                fulltext.append(u'+"{}"'.format(k.replace('"', '')))
+            elif (k):
+                query = query.where(table.c.subject.contains(k))
+
+        if (fulltext):
+            match = db.text(
+                "MATCH (message.subject) AGAINST (:fulltext IN BOOLEAN MODE)")
+            query = query.where(match)
+            bind['fulltext'] = u" ".join(fulltext)
+
+            # most relevant first, unless sorted by date
+            if (not sorted):
+                query = query.order_by(db.desc(match))
 
     if (sorted):
-        if (column):
-            records = query.order_by(Message.date.desc()).limit(
-                count).offset(row).with_entities(getattr(Message, column))
-        else:
-            records = query.order_by(
-                Message.date.desc()).limit(count).offset(row)
-    else:
-        if (column):
-            records = query.limit(count).offset(
-                row).with_entities(getattr(Message, column))
-        else:
-            records = query.limit(count).offset(row)
+        # (date, id) keyset instead of OFFSET, see encode_cursor()
+        if (cursor):
+            last = decode_cursor(cursor)
+            if (not last):
+                return jsonify(error="invalid cursor")
 
-    if (column):
-        # tuple
-        for r in records:
-            result.append({column: r[0]})
-    else:
-        for r in records:
-            result.append(r.as_dict())
+            query = query.where(db.or_(
+                table.c.date < last[0],
+                db.and_(table.c.date == last[0], table.c.id < last[1])))
+            row = 0
+
+        query = query.order_by(table.c.date.desc(), table.c.id.desc())
+
+    records = db.session.execute(query.limit(count).offset(row), bind)
+
+    n = len(names)
+    i_date = selected.index('date')
+    i_id = selected.index('id')
+    last = None
+    for r in records:
+        result.append(dict(zip(names, r[:n])))
+        last = (r[i_date], r[i_id])
+
+    if (sorted and last and len(result) == count):
+        return jsonify(result=result, next=encode_cursor(*last))
+
+    return jsonify(result=result)
+
+
+def get_ids():
+    """
+        Ids from '?ids=1,2,3', a POSTed form, a JSON {"ids": [...]} or a
+        JSON [...], ValueError for any other JSON body
+    """
+    ids = request.values.get('ids')
+    if (ids is None and request.method == "POST"):
+        data = request.get_json(silent=True)
+        if (isinstance(data, list)):
+            ids = data
+        elif (isinstance(data, dict)):
+            ids = data.get('ids')
+        elif (data is not None):
+            raise ValueError(data)
+
+    if (ids is None):
+        return []
+    if (isinstance(ids, basestring)):
+        ids = [i for i in ids.split(",") if i.strip()]
+
+    return [int(i) for i in ids]
+
+
+@app.route("/mail/batch", methods=["GET", "POST"])
+def get_batch():
+    """
+        Rows of many ids with one 'WHERE id IN (...)' per chunk, in the
+        requested order, missing ids answer {"id": id, "error": "not found"}
+    """
+    try:
+        ids = get_ids()
+    except (TypeError, ValueError):
+        return jsonify(error="invalid ids")
+
+    if (len(ids) > int(params['batch_max_ids'])):
+        return jsonify(error="too many ids")
+
+    names = get_fields()
+    if (not names):
+        return jsonify(error="unknown column")
+
+    table = Message.__table__
+    selected = names + [n for n in ['id'] if n not in names]
+    i_id = selected.index('id')
+    n = len(names)
+    size = int(params['batch_chunk_size'])
+    found = {}
+
+    unique = list(set(ids))
+    for i in range(0, len(unique), size):
+        query = db.select([table.c[c] for c in selected]).where(
+            table.c.id.in_(unique[i:i + size]))
+        for r in db.session.execute(query):
+            found[r[i_id]] = dict(zip(names, r[:n]))
+
+    result = [found.get(id, {'id': id, 'error': "not found"}) for id in ids]
 
     return jsonify(result=result)
 
@@ -144,14 +551,29 @@ def get_row_count(row, column=None, count=1):
 @app.route("/mail/<int:row>/<column>")
 def get_row(row, column=None):
     sorted = request.args.get('sorted')
+    cursor = request.args.get('cursor')
     record = None
     error = "not found"
+    next = {}
 
     if (sorted):
-        records = Message.query.order_by(
-            Message.date.desc()).limit(1).offset(row)
+        query = Message.query
+        if (cursor):
+            # the row after the cursor instead of OFFSET, see get_row_count()
+            last = decode_cursor(cursor)
+            if (not last):
+                return jsonify(error="invalid cursor")
+
+            query = query.filter(db.or_(
+                Message.date < last[0],
+                db.and_(Message.date == last[0], Message.id < last[1])))
+            row = 0
+
+        records = query.order_by(
+            Message.date.desc(), Message.id.desc()).limit(1).offset(row)
         try:
             record = records[0]
+            next = {'next': encode_cursor(record.date, record.id)}
         except IndexError, e:
             error = repr(e)
     else:
@@ -160,20 +582,264 @@ def get_row(row, column=None):
     if (record):
         if (column):
             c = {column: record[column]}
+            c.update(next)
             return jsonify(**c)
         else:
-            return jsonify(result=[record.as_dict()])
+            return jsonify(result=[record.as_dict()], **next)
     else:
         return jsonify(error=error)
 
 
+def export_rows(since=None, until=None):
+    """
+        Yield chunks of rows of the message table from a server-side
+        cursor, the result set is never held in memory
+    """
+    table = Message.__table__
+    # the range and the order are both served by idx_date (date, id)
+    query = db.select([table]).order_by(table.c.date, table.c.id)
+    if (since is not None):
+        query = query.where(table.c.date >= since)
+    if (until is not None):
+        query = query.where(table.c.date < until)
+
+    conn = db.engine.connect().execution_options(stream_results=True)
+    try:
+        result = conn.execute(query)
+        while (True):
+            rows = result.fetchmany(int(params['export_chunk_size']))
+            if (not rows):
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def to_ndjson(chunks):
+    for rows in chunks:
+        yield "".join(json.dumps(dict(r)) + "\n" for r in rows)
+
+
+def to_csv(chunks):
+    names = [c.name for c in Message.__table__.columns]
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf)
+
+    writer.writerow(names)
+    for rows in itertools.chain([[]], chunks):
+        for r in rows:
+            writer.writerow([r[n].encode("utf-8") if isinstance(r[n], unicode)
+                             else r[n] for n in names])
+        # header goes out before the first query returns
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+@app.route("/export")
+@app.route("/export.<format>")
+def export(format="ndjson"):
+    """Stream the message table as NDJSON or CSV, ?since= and ?until= in epoch"""
+    since = request.args.get('since', type=int)
+    until = request.args.get('until', type=int)
+
+    if (format == "ndjson"):
+        body, mimetype = to_ndjson, "application/x-ndjson"
+    elif (format == "csv"):
+        body, mimetype = to_csv, "text/csv"
+    else:
+        return jsonify(error="unknown format"), 400
+
+    return Response(stream_with_context(body(export_rows(since, until))),
+                    mimetype=mimetype)
+
+
+def get_range():
+    """(since, until) epoch of '?since=' and '?until=', 'report_days' by default"""
+    until = request.args.get('until', type=int)
+    if (until is None):
+        until = int(time.time())
+    since = request.args.get('since', type=int)
+    if (since is None):
+        since = until - int(params['report_days']) * 86400
+
+    return (since, until)
+
+
+def to_epoch(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def get_timezone():
+    """
+        Timezone the ingester computed the daily rollups in, so that the
+        buckets match their days, 'report_timezone' until it has run
+    """
+    try:
+        row = db.session.execute(
+            "SELECT timezone FROM message_daily_info WHERE id = 1").fetchone()
+    except (exc.ProgrammingError, exc.OperationalError):
+        db.session.rollback()
+        row = None
+
+    if (row and row[0]):
+        return row[0]
+
+    return params['report_timezone']
+
+
+def get_buckets(bucket, since, until, tz_name):
+    """
+        Boundaries of hour/day/week/month buckets covering [since, until)
+        in the timezone 'tz_name', stops after 'report_max_buckets' + 1
+        buckets
+    """
+    today = py_today.Today(since, tz_name)
+    max_buckets = int(params['report_max_buckets'])
+
+    if (bucket == "hour"):
+        dt = today.get_datetime().replace(minute=0, second=0, microsecond=0)
+        first = lambda t: t
+        step = 3600
+        since = to_epoch(dt)
+    elif (bucket == "day"):
+        first = lambda t: to_epoch(today.begin_of_today(t))
+        step = 86400 + 43200
+    elif (bucket == "week"):
+        first = lambda t: to_epoch(today.first_of_this_week(t))
+        step = 86400 * 7 + 43200
+    elif (bucket == "month"):
+        first = lambda t: to_epoch(today.first_of_this_month(t))
+        step = 86400 * 31 + 43200
+    else:
+        return None
+
+    # the next boundary is the first one after half a bucket more, so
+    # 23/25 hour days or short months never skip or repeat a bucket
+    bounds = [first(since)]
+    while (bounds[-1] < until and len(bounds) - 1 <= max_buckets):
+        t = bounds[-1]
+        bounds.append(first(t + step))
+
+    return bounds
+
+
+@app.route("/report/senders")
+def get_report_senders():
+    """Top-N senders by message count in '?since=' .. '?until='"""
+    since, until = get_range()
+    top = request.args.get('top', type=int) or int(params['report_top'])
+    top = max(top, 1)
+
+    records = db.session.execute("""
+        SELECT s_from, COUNT(*) AS count FROM message
+        WHERE date >= :since AND date < :until
+        GROUP BY s_from ORDER BY count DESC LIMIT :top
+    """, {'since': since, 'until': until, 'top': top})
+
+    result = [{'s_from': r[0], 'count': int(r[1])} for r in records]
+
+    return jsonify(result=result, since=since, until=until)
+
+
+@app.route("/report/<bucket>")
+def get_report_buckets(bucket):
+    """
+        Message counts per hour/day/week/month bucket, optionally of one
+        sender by '?s_from='
+    """
+    since, until = get_range()
+    s_from = request.args.get('s_from')
+
+    tz_name = get_timezone()
+    bounds = get_buckets(bucket, since, until, tz_name)
+    if (not bounds):
+        return jsonify(error="unknown bucket")
+    if (len(bounds) - 1 > int(params['report_max_buckets'])):
+        return jsonify(error="too many buckets")
+
+    # INTERVAL() numbers the bucket of each date in one range scan of
+    # idx_date (idx_from_date with a sender), days and longer are summed
+    # from the daily rollups of the ingester instead
+    if (bucket == "hour"):
+        column, table, count = "date", "message", "COUNT(*)"
+    elif (s_from):
+        column, table, count = "day", "message_daily", "SUM(count)"
+    else:
+        column, table, count = "day", "message_daily_total", "SUM(count)"
+
+    bind = dict(("b{}".format(i), b) for i, b in enumerate(bounds))
+    sql = """
+        SELECT INTERVAL({column}, {marks}) AS bucket, {count} FROM {table}
+        WHERE {column} >= :b0 AND {column} < :b{last}
+    """.format(column=column, table=table, count=count,
+               marks=", ".join(":b{}".format(i) for i in range(len(bounds))),
+               last=len(bounds) - 1)
+    if (s_from):
+        sql = sql + " AND s_from = :s_from"
+        bind['s_from'] = s_from
+    sql = sql + " GROUP BY bucket"
+
+    counts = {}
+    for r in db.session.execute(sql, bind):
+        counts[int(r[0])] = int(r[1])
+
+    result = [{'date': b, 'count': counts.get(i + 1, 0)}
+              for i, b in enumerate(bounds[:-1])]
+
+    return jsonify(result=result, timezone=tz_name)
+
+
 @app.route("/")
 def index():
     return render_template('index.html')
 
 
+@app.route("/health")
+def health():
+    """Liveness of the worker, never touches the database"""
+    return jsonify(status="ok")
+
+
+def serve(host, port, workers, threads):
+    """
+        Pre-fork 'workers' processes of 'threads' threads with gunicorn,
+        or fall back to the threaded werkzeug server without it
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        app.run(host=host, port=port, debug=False, threaded=True)
+        return
+
+    class Server(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set("bind", "{}:{}".format(host, port))
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
 def main():
-    app.run(host="0.0.0.0", debug=True)
+    parser = argparse.ArgumentParser(description="Simple RESTful API")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="run the single-process debug server")
+    args = parser.parse_args()
+
+    host = params['server_host']
+    port = int(params['server_port'])
+
+    if (args.debug):
+        app.run(host=host, port=port, debug=True)
+    else:
+        serve(host, port,
+              int(params['server_workers']), int(params['server_threads']))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#=========================================================================
+#
+#         FILE: web_test.py
+#
+#        USAGE: ./web_test.py
+#
+#  DESCRIPTION: Unit test for the RESTful API, against SQLite
+#
+#      OPTIONS: ---
+# REQUIREMENTS: ---
+#         BUGS: ---
+#        NOTES: ---
+#       AUTHOR: SHIE, Li-Yi (lyshie), lyshie@mx.nthu.edu.tw
+# ORGANIZATION:
+#      VERSION: 1.0
+#      CREATED: 2014-11-12 10:21:05
+#     REVISION: ---
+#=========================================================================
+
+import unittest
+import getpass
+import json
+import os
+import tempfile
+
+# web.py asks for the MySQL password on import without web.conf
+getpass.getpass = lambda prompt="": ""
+
+import web
+
+
+class WebTestCase(unittest.TestCase):
+
+    rows = [(u'a', 1, u'x@example.com'),
+            (u'b', 2, u'y@example.com'),
+            (u'c', 2, u'z@example.com'),
+            (u'd', 3, u'x@example.com')]
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+
+        # the engine is created on first use, so it can still be swapped
+        web.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + self.filename
+        web.app.config["SQLALCHEMY_POOL_SIZE"] = None
+        web.app.config["SQLALCHEMY_MAX_OVERFLOW"] = None
+        web.response_cache = None
+        web.fulltext_cache['enabled'] = None
+
+        web.db.create_all()
+        for subject, date, s_from in self.rows:
+            web.db.session.add(
+                web.Message(subject=subject, date=date, s_from=s_from))
+        web.db.session.commit()
+
+        self.client = web.app.test_client()
+
+    def tearDown(self):
+        web.db.session.remove()
+        os.remove(self.filename)
+
+    def get(self, url):
+        return json.loads(self.client.get(url).data)
+
+    def test_fields(self):
+        expected = [{'subject': u'a', 'date': 1}, {'subject': u'b', 'date': 2}]
+        result = self.get("/mail/0/2?fields=subject,date")['result']
+
+        self.assertEqual(expected, result)
+
+    def test_fields_repeated(self):
+        expected = [{'subject': u'a'}, {'subject': u'b'}]
+        result = self.get("/mail/0/2?fields=subject,subject")['result']
+
+        self.assertEqual(expected, result)
+
+    def test_fields_unknown(self):
+        expected = {'error': "unknown column"}
+
+        self.assertEqual(expected, self.get("/mail/0/2?fields=subject,password"))
+        self.assertEqual(expected, self.get("/mail/0/2/password"))
+
+    def test_cursor(self):
+        expected = [u'd', u'c', u'b', u'a']
+
+        page = self.get("/mail/0/2?sorted=1&fields=subject")
+        result = [r['subject'] for r in page['result']]
+        page = self.get("/mail/0/2?sorted=1&fields=subject&cursor=" +
+                        page['next'])
+        result.extend([r['subject'] for r in page['result']])
+
+        self.assertEqual(expected, result)
+        # a full last page still has a cursor, the page after is empty
+        page = self.get("/mail/0/2?sorted=1&cursor=" + page['next'])
+        self.assertEqual([], page['result'])
+        self.assertTrue('next' not in page)
+
+    def test_cursor_invalid(self):
+        expected = {'error': "invalid cursor"}
+        result = self.get("/mail/0/2?sorted=1&cursor=xyz")
+
+        self.assertEqual(expected, result)
+
+    def test_row_cursor(self):
+        expected = [u'd', u'c', u'b', u'a']
+
+        result = []
+        url = "/mail/0/subject?sorted=1"
+        for n in range(4):
+            row = self.get(url)
+            result.append(row['subject'])
+            url = "/mail/0/subject?sorted=1&cursor=" + row['next']
+
+        self.assertEqual(expected, result)
+        self.assertTrue('error' in self.get(url))
+
+    def post(self, url, data):
+        return json.loads(self.client.post(
+            url, data=json.dumps(data), content_type="application/json").data)
+
+    def test_keyword_like(self):
+        # SQLite has no FULLTEXT index, every keyword uses LIKE
+        expected = [{'subject': u'mail server'}]
+
+        web.db.session.add(web.Message(subject=u'mail server', date=4))
+        web.db.session.add(web.Message(subject=u'mail', date=5))
+        web.db.session.commit()
+        result = self.get("/mail/0/10?keyword=mail,er&fields=subject")['result']
+
+        self.assertEqual(expected, result)
+        self.assertFalse(web.has_fulltext())
+
+    def test_batch(self):
+        expected = [{'subject': u'd'}, {'id': 9, 'error': "not found"},
+                    {'subject': u'a'}, {'subject': u'd'}]
+        result = self.get("/mail/batch?ids=4,9,1,4&fields=subject")['result']
+
+        self.assertEqual(expected, result)
+
+    def test_batch_fields_repeated(self):
+        expected = [{'subject': u'b'}]
+        result = self.get("/mail/batch?ids=2&fields=subject,subject")['result']
+
+        self.assertEqual(expected, result)
+
+    def test_batch_post(self):
+        expected = [u'c', u'a']
+
+        for data in [{'ids': [3, 1]}, [3, 1]]:
+            result = [r['subject'] for r in self.post("/mail/batch", data)['result']]
+            self.assertEqual(expected, result)
+
+    def test_batch_invalid(self):
+        expected = {'error': "invalid ids"}
+
+        self.assertEqual(expected, self.post("/mail/batch", "1,2"))
+        self.assertEqual(expected, self.post("/mail/batch", [1, {}]))
+        self.assertEqual(expected, self.get("/mail/batch?ids=1,x"))
+
+    def test_batch_chunks(self):
+        size = web.params['batch_chunk_size']
+        web.params['batch_chunk_size'] = '1'
+        try:
+            result = self.get("/mail/batch?ids=3,2,1&fields=id")['result']
+        finally:
+            web.params['batch_chunk_size'] = size
+
+        self.assertEqual([{'id': 3}, {'id': 2}, {'id': 1}], result)
+
+    def test_senders_top(self):
+        expected = [{'s_from': u'x@example.com', 'count': 2}]
+
+        for top in ["1", "-1"]:
+            result = self.get("/report/senders?since=0&until=10&top=" + top)
+            self.assertEqual(expected, result['result'])
+
+        result = self.get("/report/senders?since=0&until=3")
+        self.assertEqual(3, len(result['result']))
+
+    def test_report_max_buckets(self):
+        expected = {'error': "too many buckets"}
+
+        size = web.params['report_max_buckets']
+        web.params['report_max_buckets'] = '24'
+        try:
+            result = self.get("/report/hour?since=0&until={}".format(25 * 3600))
+        finally:
+            web.params['report_max_buckets'] = size
+
+        self.assertEqual(expected, result)
+
+    def test_range_until_zero(self):
+        expected = []
+        result = self.get("/report/senders?since=0&until=0")['result']
+
+        self.assertEqual(expected, result)
+
+
+class BucketTestCase(unittest.TestCase):
+
+    # 2014-10-24 00:00:00 +0800, a Friday
+    day = 1414080000
+
+    def setUp(self):
+        self.max_buckets = web.params['report_max_buckets']
+        web.params['report_max_buckets'] = '24'
+
+    def tearDown(self):
+        web.params['report_max_buckets'] = self.max_buckets
+
+    def buckets(self, bucket, since, until):
+        return web.get_buckets(bucket, since, until, 'Asia/Taipei')
+
+    def test_hour(self):
+        expected = [self.day, self.day + 3600, self.day + 7200]
+        result = self.buckets("hour", self.day + 1800, self.day + 7200)
+
+        self.assertEqual(expected, result)
+
+    def test_day(self):
+        expected = [self.day - 86400, self.day, self.day + 86400]
+        result = self.buckets("day", self.day - 1, self.day + 1)
+
+        self.assertEqual(expected, result)
+        # a range ending on a boundary does not open another bucket
+        self.assertEqual([self.day, self.day + 86400],
+                         self.buckets("day", self.day, self.day + 86400))
+
+    def test_week(self):
+        # Monday 2014-10-20 .. Monday 2014-10-27
+        expected = [self.day - 4 * 86400, self.day + 3 * 86400]
+        result = self.buckets("week", self.day, self.day + 1)
+
+        self.assertEqual(expected, result)
+
+    def test_month(self):
+        # 2014-10-01, 2014-11-01, 2014-12-01 +0800
+        expected = [1412092800, 1414771200, 1417363200]
+        result = self.buckets("month", self.day, 1414771200 + 1)
+
+        self.assertEqual(expected, result)
+
+    def test_max_buckets(self):
+        # exactly 'report_max_buckets' is allowed, one more is not
+        result = self.buckets("hour", self.day, self.day + 24 * 3600)
+        self.assertEqual(24, len(result) - 1)
+
+        result = self.buckets("hour", self.day, self.day + 25 * 3600)
+        self.assertEqual(25, len(result) - 1)
+
+    def test_unknown(self):
+        self.assertEqual(None, self.buckets("year", self.day, self.day + 1))
+
+
+def main():
+    suite = unittest.TestSuite()
+    for case in [WebTestCase, BucketTestCase]:
+        suite.addTests(unittest.TestLoader().loadTestsFromTestCase(case))
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    main()